@@ -1,9 +1,25 @@
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import ctypes
 from datetime import datetime, timezone, timedelta
+import errno
 import hashlib
 import json
 import mimetypes
 import os
+import shutil
+import sqlite3
+import struct
+import tarfile
+import threading
+import time
 import xml.etree.ElementTree as ET
+import zlib
+try:
+    import fcntl
+except ImportError: #not on Windows
+    fcntl = None
 
 
 class ObjectNotFound(RuntimeError):
@@ -21,12 +37,19 @@ class DateTimeError(RuntimeError):
 class FixityError(RuntimeError):
     pass
 
+class ObjectWriteError(RuntimeError):
+    pass
+
 
 NUM_BYTES_TO_READ = 20_000_000 # ~20Mb
+ARCHIVE_CHUNK_SIZE = 1_000_000 # ~1Mb
 RELS_INT_NS = {'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#', 'ns1': 'info:fedora/fedora-system:def/model#'}
 DNG_MIMETYPE = 'image/x-adobe-dng'
 JS_MIMETYPE = 'application/javascript'
 MKV_MIMETYPE = 'video/x-matroska'
+FICLONE = 0x40049409 #linux ioctl for a copy-on-write clone (reflink) of a file
+OBJECT_DECLARATION = '0=ocfl_object_1.0'
+OBJECT_DECLARATION_CONTENT = b'ocfl_object_1.0\n'
 
 mimetypes.add_type(DNG_MIMETYPE, '.dng', strict=False)
 mimetypes.add_type(JS_MIMETYPE, '.js', strict=False)
@@ -68,6 +91,20 @@ def get_file_size(full_path):
     return os.stat(full_path).st_size
 
 
+def _reflink_or_copy(src_path, dest_path):
+    #errors opening either file propagate unchanged - only a failed clone falls back to copying
+    with open(src_path, 'rb') as src, open(dest_path, 'xb') as dest:
+        if fcntl:
+            try:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+                return 'reflinked'
+            except OSError:
+                #filesystem doesn't support reflinks (or src & dest are on different filesystems)
+                pass
+        shutil.copyfileobj(src, dest, ARCHIVE_CHUNK_SIZE)
+    return 'copied'
+
+
 def object_path(storage_root, pid):
     sha256_checksum = hashlib.sha256(pid.encode('utf8')).hexdigest()
     return os.path.join(
@@ -160,14 +197,15 @@ def utc_datetime_from_string(date_string):
         except DateTimeError:
             raise
         except Exception:
-            raise DateTimeError(f'error parsing {datestring}')
+            raise DateTimeError(f'error parsing {date_string}')
 
 
 class Object:
 
-    def __init__(self, storage_root, pid, fallback_to_version_directory=True, deleted_ok=False):
+    def __init__(self, storage_root, pid, fallback_to_version_directory=True, deleted_ok=False, content_cache=None):
         self.pid = pid
         self._fallback_to_version_directory = fallback_to_version_directory
+        self._content_cache = content_cache
         self.object_path = object_path(storage_root, self.pid)
         if not os.path.exists(self.object_path):
             raise ObjectNotFound(f'{self.pid} not found')
@@ -205,6 +243,57 @@ class Object:
                 raise InventoryError(f'{self.pid} missing root inventory - not trying version directory')
         return json.loads(data)
 
+    def _get_version_path_checksums(self, versions, index):
+        #versions is a list of (version_num, {filepath: checksum}), newest version first - it's only
+        #  built as far back as it's needed
+        while len(versions) <= index:
+            version_num = f'v{int(self.head_version.replace("v", "")) - len(versions)}'
+            path_checksums = {}
+            for checksum, filepaths in self._inventory['versions'][version_num]['state'].items():
+                for filepath in filepaths:
+                    path_checksums[filepath] = checksum
+            versions.append((version_num, path_checksums))
+        return versions[index]
+
+    def _get_file_info(self, filepath, versions, rels_int_roots):
+        num_versions = int(self.head_version.replace('v', ''))
+        #find the newest version with the file - if it's not the head version, the file was deleted
+        for index in range(num_versions):
+            version_num, path_checksums = self._get_version_path_checksums(versions, index)
+            if filepath in path_checksums:
+                break
+        else:
+            raise FileNotFoundError(f'no {filepath} file in {self.pid}')
+        checksum = path_checksums[filepath]
+        #need to backtrack through versions to get/verify the correct lastModified time
+        #if a file was present with the same checksum in the previous version, then the lastModified time needs to be updated
+        last_modified_version = version_num
+        for older_index in range(index + 1, num_versions):
+            older_version_num, older_path_checksums = self._get_version_path_checksums(versions, older_index)
+            if filepath not in older_path_checksums:
+                break
+            if older_path_checksums[filepath] == checksum:
+                last_modified_version = older_version_num
+        file_info = {
+                'lastModified': utc_datetime_from_string(self._inventory['versions'][last_modified_version]['created']),
+                'checksum': checksum,
+                'checksumType': 'SHA-512',
+                'state': 'A' if index == 0 else 'D',
+                'size': get_file_size(os.path.join(self.object_path, self._inventory['manifest'][checksum][0])),
+            }
+        if index == 0:
+            rels_int_root = self.rels_int_root
+        else:
+            if version_num not in rels_int_roots:
+                rels_int_roots[version_num] = self._get_rels_int_root(version=version_num)
+            rels_int_root = rels_int_roots[version_num]
+        download_filename = get_download_filename_from_rels_int(rels_int_root, self.pid, filepath)
+        if not download_filename:
+            download_filename = filepath
+        file_info['mimetype'] = get_mimetype_from_filename(download_filename)
+        file_info['downloadFilename'] = download_filename
+        return file_info
+
     def _get_files_info(self):
         files_info = {}
         for checksum, filepaths in self._inventory['versions'][self.head_version]['state'].items():
@@ -270,8 +359,8 @@ class Object:
 
     def _get_rels_int_root(self, version):
         try:
-            rels_int_path = self.get_path_to_file('RELS-INT', version=version)
-            return load_rels_int(rels_int_path)
+            with self.open_file('RELS-INT', version=version) as rels_int_file:
+                return ET.fromstring(rels_int_file.read())
         except FileNotFoundError:
             pass
 
@@ -281,15 +370,70 @@ class Object:
             self._rels_int_root = self._get_rels_int_root(self.head_version)
         return self._rels_int_root
 
-    def get_path_to_file(self, filename, version=None):
+    def _get_checksum_and_content_path(self, filename, version):
         if not version:
             version = self._inventory['head']
         for checksum, files in self._inventory['versions'][version]['state'].items():
             for f in files:
                 if f == filename:
-                    return os.path.join(self.object_path, self._inventory['manifest'][checksum][0])
+                    return checksum, os.path.join(self.object_path, self._inventory['manifest'][checksum][0])
         raise FileNotFoundError(f'no {filename} file in version {version}')
 
+    def get_path_to_file(self, filename, version=None):
+        checksum, content_path = self._get_checksum_and_content_path(filename, version)
+        if self._content_cache:
+            return self._content_cache.get_path(checksum, content_path)
+        return content_path
+
+    def open_file(self, filename, version=None):
+        '''binary file object for the file - prefer this over get_path_to_file() with a content cache,
+        since the cached copy can't be evicted out from under it'''
+        checksum, content_path = self._get_checksum_and_content_path(filename, version)
+        if self._content_cache:
+            return self._content_cache.open_file(checksum, content_path)
+        return open(content_path, 'rb')
+
+    def checkout(self, version, dest_dir, hardlink=True, max_workers=4):
+        '''write out the files in a version (head version if None) as a directory tree in dest_dir
+
+        Files are hardlinked to the content files when possible, which is nearly instant - but
+        they share their data with the OCFL content, so they must not be modified (pass
+        hardlink=False to skip hardlinks). Otherwise, files are reflinked or copied, in parallel.
+        Returns the number of files linked, reflinked and copied.'''
+        version = version or self.head_version
+        manifest = self._inventory['manifest']
+        real_dest_dir = os.path.realpath(dest_dir)
+        #check every path before writing anything, so a bad inventory doesn't leave a partial tree
+        files = []
+        for checksum, filepaths in self._inventory['versions'][version]['state'].items():
+            src_path = os.path.join(self.object_path, manifest[checksum][0])
+            for filepath in filepaths:
+                dest_path = os.path.join(real_dest_dir, filepath)
+                if not os.path.realpath(dest_path).startswith(real_dest_dir + os.sep):
+                    raise InventoryError(f'{self.pid} {version} has invalid logical path {filepath}')
+                files.append((src_path, dest_path))
+        os.makedirs(dest_dir, exist_ok=True)
+        counts = {'linked': 0, 'reflinked': 0, 'copied': 0}
+        to_copy = []
+        for src_path, dest_path in files:
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            if hardlink:
+                try:
+                    os.link(src_path, dest_path)
+                    counts['linked'] += 1
+                    continue
+                except OSError as e:
+                    if e.errno in (errno.EXDEV, errno.EPERM):
+                        #a different filesystem, or one without hardlinks - no point trying to link the rest
+                        hardlink = False
+                    elif e.errno != errno.EMLINK:
+                        raise
+            to_copy.append((src_path, dest_path))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(lambda paths: _reflink_or_copy(*paths), to_copy):
+                counts[result] += 1
+        return counts
+
     @property
     def filenames(self):
         #grab these from inventory.json, instead of self._files_info, so we don't require _get_files_info() to be run
@@ -322,6 +466,30 @@ class Object:
                 files_info[filename] = {field: value for field, value in info.items() if field in fields}
         return files_info
 
+    def iter_files_info(self, fields=None, include_deleted=False, start_after=None, limit=None):
+        '''generate (filename, info) pairs in filename order, starting after the start_after filename
+
+        Unlike get_files_info(), each file's info is only looked up when it's reached,
+        so the first page of a large object is fast.'''
+        if include_deleted:
+            filenames = sorted(self.all_filenames)
+        else:
+            filenames = sorted(self.filenames)
+        start = bisect.bisect_right(filenames, start_after) if start_after is not None else 0
+        end = start + limit if limit is not None else len(filenames)
+        #per-version lookups for the files on this page, shared between files but not kept on the object
+        versions = []
+        rels_int_roots = {}
+        for filename in filenames[start:end]:
+            if not fields:
+                yield filename, {}
+                continue
+            if self._files_info:
+                info = self._files_info[filename]
+            else:
+                info = self._get_file_info(filename, versions, rels_int_roots)
+            yield filename, {field: value for field, value in info.items() if field in fields}
+
 
 def walk_repo(storage_root, top_ntuple_segment=None):
     '''generate all the pids in a repo
@@ -359,6 +527,18 @@ def _check_inventory_fixity(directory, label):
         raise FixityError(f'{label} inventory.json: calculated={inventory_hash}; recorded={recorded_inventory_hash}')
 
 
+def _hash_file(path):
+    sha512 = hashlib.sha512()
+    with open(path, 'rb') as f:
+        while True:
+            file_bytes = f.read(NUM_BYTES_TO_READ)
+            if file_bytes:
+                sha512.update(file_bytes)
+            else:
+                break
+    return sha512.hexdigest()
+
+
 def check_fixity(obj):
     #check root and version directory inventories
     _check_inventory_fixity(obj.object_path, 'root')
@@ -370,14 +550,1368 @@ def check_fixity(obj):
     #check all content files
     for recorded_checksum, file_paths in obj._inventory['manifest'].items():
         for file_path in file_paths:
-            sha512 = hashlib.sha512()
-            with open(os.path.join(obj.object_path, file_path), 'rb') as f:
-                while True:
-                    file_bytes = f.read(NUM_BYTES_TO_READ)
-                    if file_bytes:
-                        sha512.update(file_bytes)
-                    else:
-                        break
-            file_checksum = sha512.hexdigest()
+            file_checksum = _hash_file(os.path.join(obj.object_path, file_path))
             if file_checksum != recorded_checksum:
                 raise FixityError(f'{file_path}: calculated={file_checksum}; recorded={recorded_checksum}')
+
+
+def _temp_path(path):
+    #unique per process & thread, so parallel writers never share a temp file
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def _write_file_atomically(path, data):
+    tmp_path = _temp_path(path)
+    try:
+        with open(tmp_path, 'xb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _copy_and_hash(src_path, dest_path):
+    '''copy src_path to dest_path (via a temp file & rename), calculating the sha512 in the same pass'''
+    sha512 = hashlib.sha512()
+    tmp_path = _temp_path(dest_path)
+    try:
+        with open(src_path, 'rb') as src, open(tmp_path, 'xb') as dest:
+            while True:
+                file_bytes = src.read(NUM_BYTES_TO_READ)
+                if file_bytes:
+                    sha512.update(file_bytes)
+                    dest.write(file_bytes)
+                else:
+                    break
+            dest.flush()
+            os.fsync(dest.fileno())
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return sha512.hexdigest()
+
+
+def _utc_now_string():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class ObjectBuilder:
+    '''Write a new version of an object (creating the object if it doesn't exist yet).
+
+    The new version starts with the state of the current head version. Content
+    is hashed while it's copied, and inventories are written to temp files and
+    renamed into place, with the root inventory written last.
+
+    With dedup on, content whose checksum is already in the manifest (or that
+    duplicates other content in the new version) is referenced instead of
+    written again. Pass a known checksum to add_file() to skip reading a
+    duplicate file entirely. With a ChecksumIndex, content that's already stored
+    in another object is hardlinked from there when possible.
+
+        builder = ObjectBuilder(storage_root, pid, message='update MODS', user_name='Alice')
+        builder.add_file('MODS', '/path/to/mods.xml')
+        builder.remove_file('old.txt')
+        builder.commit()'''
+
+    def __init__(self, storage_root, pid, message='', user_name=None, user_address=None, created=None, max_workers=4, dedup=True, checksum_index=None):
+        self.pid = pid
+        self.object_path = object_path(storage_root, pid)
+        self._max_workers = max_workers
+        self._dedup = dedup
+        self._checksum_index = checksum_index
+        if os.path.exists(self.object_path):
+            obj = Object(storage_root, pid, fallback_to_version_directory=False, deleted_ok=True)
+            self._inventory = obj._inventory
+            self.version_num = f'v{int(obj.head_version.replace("v", "")) + 1}'
+            head_state = self._inventory['versions'][obj.head_version]['state']
+        else:
+            self._inventory = {
+                    'digestAlgorithm': 'sha512',
+                    'id': pid,
+                    'type': 'https://ocfl.io/1.0/spec/#inventory',
+                    'manifest': {},
+                    'versions': {},
+                }
+            self.version_num = 'v1'
+            head_state = {}
+        #logical path -> checksum for files carried over from the previous version
+        self._state = {}
+        for checksum, filepaths in head_state.items():
+            for filepath in filepaths:
+                self._state[filepath] = checksum
+        #logical path -> (source file path or bytes, expected checksum), for new content
+        self._pending = {}
+        self._version = {
+                'created': created or _utc_now_string(),
+                'message': message,
+                'state': {},
+            }
+        if user_name:
+            self._version['user'] = {'name': user_name}
+            if user_address:
+                self._version['user']['address'] = user_address
+        #sizes of the existing content files, so we only pre-hash new files that could be duplicates
+        self._manifest_sizes = None
+        self._manifest_sizes_lock = threading.Lock()
+        #logical paths that were added but didn't need their content written
+        self.deduplicated = []
+        #logical paths whose content was hardlinked from another object
+        self.linked = []
+        #set if the version was committed, but the checksum index couldn't be updated for it
+        self.index_error = None
+        self._committed = False
+
+    @staticmethod
+    def _check_logical_path(logical_path):
+        segments = logical_path.split('/')
+        if logical_path.startswith('/') or any(segment in ['', '.', '..'] for segment in segments):
+            raise ObjectWriteError(f'invalid logical path: {logical_path}')
+
+    def add_file(self, logical_path, source_path, checksum=None):
+        ObjectBuilder._check_logical_path(logical_path)
+        self._state.pop(logical_path, None)
+        self._pending.pop(logical_path, None)
+        if checksum and self._dedup and checksum in self._inventory['manifest']:
+            self._state[logical_path] = checksum
+            self.deduplicated.append(logical_path)
+        else:
+            self._pending[logical_path] = (source_path, checksum)
+
+    def add_bytes(self, logical_path, content):
+        ObjectBuilder._check_logical_path(logical_path)
+        self._state.pop(logical_path, None)
+        self._pending[logical_path] = (content, None)
+
+    def remove_file(self, logical_path):
+        if logical_path in self._pending:
+            del self._pending[logical_path]
+        elif logical_path in self._state:
+            del self._state[logical_path]
+        else:
+            raise FileNotFoundError(f'no {logical_path} file in {self.pid}')
+
+    def _get_manifest_sizes(self):
+        #only needed for add_file() sources, so other commits don't stat the whole manifest
+        with self._manifest_sizes_lock:
+            if self._manifest_sizes is None:
+                sizes = None
+                if self._checksum_index and self._inventory['manifest']:
+                    sizes = self._checksum_index.object_sizes(self.pid, _read_inventory_digest(self.object_path))
+                if sizes is None:
+                    sizes = {get_file_size(os.path.join(self.object_path, content_paths[0])) for content_paths in self._inventory['manifest'].values()}
+                self._manifest_sizes = sizes
+            return self._manifest_sizes
+
+    def _link_existing_content(self, checksum, size, full_path):
+        if not (self._dedup and self._checksum_index):
+            return False
+        existing_path = self._checksum_index.find_content_path(checksum)
+        if not existing_path:
+            return False
+        tmp_path = _temp_path(full_path)
+        try:
+            os.link(existing_path, tmp_path)
+        except OSError:
+            #eg. different filesystem, or the other object's content is gone - just write the content
+            return False
+        if get_file_size(tmp_path) != size:
+            #the index is stale, and that file has changed since
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, full_path)
+        return True
+
+    def _write_content(self, content_path, source, checksum):
+        '''returns the checksum of the content, and whether it was 'written', 'linked', or already in the manifest ('existing')'''
+        manifest = self._inventory['manifest']
+        full_path = os.path.join(self.object_path, content_path)
+        if isinstance(source, bytes):
+            file_checksum = hashlib.sha512(source).hexdigest()
+            if self._dedup and file_checksum in manifest:
+                return file_checksum, 'existing'
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            if self._link_existing_content(file_checksum, len(source), full_path):
+                return file_checksum, 'linked'
+            _write_file_atomically(full_path, source)
+            return file_checksum, 'written'
+        if self._dedup:
+            size = get_file_size(source)
+            might_be_duplicate = size in self._get_manifest_sizes() or (self._checksum_index and self._checksum_index.has_size(size))
+        else:
+            might_be_duplicate = False
+        if might_be_duplicate:
+            #a read-only pass here saves the write if it is a duplicate
+            file_checksum = _hash_file(source)
+            if checksum and checksum != file_checksum:
+                raise FixityError(f'{source}: calculated={file_checksum}; expected={checksum}')
+            if file_checksum in manifest:
+                return file_checksum, 'existing'
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            if self._link_existing_content(file_checksum, size, full_path):
+                return file_checksum, 'linked'
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        file_checksum = _copy_and_hash(source, full_path)
+        if checksum and checksum != file_checksum:
+            os.remove(full_path)
+            raise FixityError(f'{source}: calculated={file_checksum}; expected={checksum}')
+        return file_checksum, 'written'
+
+    def _remove_content_file(self, content_path):
+        os.remove(os.path.join(self.object_path, content_path))
+        #OCFL doesn't allow empty directories in the content directory
+        content_root = os.path.join(self.object_path, self.version_num, 'content')
+        directory = os.path.dirname(os.path.join(self.object_path, content_path))
+        while directory != content_root:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def _write_inventory_files(self, directory, inventory_bytes, inventory_hash):
+        _write_file_atomically(os.path.join(directory, 'inventory.json'), inventory_bytes)
+        _write_file_atomically(os.path.join(directory, 'inventory.json.sha512'), f'{inventory_hash}\tinventory.json'.encode('utf8'))
+
+    def commit(self):
+        '''write the content files & inventories, and return the new version number'''
+        if self._committed:
+            raise ObjectWriteError(f'{self.pid} {self.version_num} already committed')
+        version_path = os.path.join(self.object_path, self.version_num)
+        #creating the version directory doubles as a lock against another writer creating the same version
+        try:
+            os.makedirs(version_path)
+        except FileExistsError:
+            raise ObjectWriteError(f'{self.pid} {self.version_num} directory already exists')
+        try:
+            manifest = self._inventory['manifest']
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                futures = {}
+                for logical_path, (source, checksum) in self._pending.items():
+                    content_path = f'{self.version_num}/content/{logical_path}'
+                    futures[content_path] = (logical_path, executor.submit(self._write_content, content_path, source, checksum))
+                #the manifest isn't updated until all the workers are done, since they check it for duplicates
+                results = [(content_path, logical_path, future.result()) for content_path, (logical_path, future) in futures.items()]
+            for content_path, logical_path, (checksum, status) in results:
+                if status != 'existing' and not (self._dedup and checksum in manifest):
+                    manifest.setdefault(checksum, []).append(content_path)
+                    if status == 'linked':
+                        self.linked.append(logical_path)
+                else:
+                    if status != 'existing':
+                        #another new file in this version has the same content
+                        self._remove_content_file(content_path)
+                    self.deduplicated.append(logical_path)
+                self._state[logical_path] = checksum
+            for logical_path, checksum in sorted(self._state.items()):
+                self._version['state'].setdefault(checksum, []).append(logical_path)
+            self._inventory['versions'][self.version_num] = self._version
+            self._inventory['head'] = self.version_num
+            inventory_bytes = json.dumps(self._inventory).encode('utf8')
+            inventory_hash = hashlib.sha512(inventory_bytes).hexdigest()
+            self._write_inventory_files(version_path, inventory_bytes, inventory_hash)
+            if self.version_num == 'v1':
+                _write_file_atomically(os.path.join(self.object_path, OBJECT_DECLARATION), OBJECT_DECLARATION_CONTENT)
+        except BaseException:
+            #don't leave a partial version behind - its directory would block every later commit
+            shutil.rmtree(version_path, ignore_errors=True)
+            if self.version_num == 'v1':
+                try:
+                    os.remove(os.path.join(self.object_path, OBJECT_DECLARATION))
+                except FileNotFoundError:
+                    pass
+                try:
+                    os.rmdir(self.object_path)
+                except OSError:
+                    pass
+            raise
+        #replacing the root inventory is what makes the new version visible to readers
+        self._write_inventory_files(self.object_path, inventory_bytes, inventory_hash)
+        self._committed = True
+        if self._checksum_index:
+            #the version is committed at this point, so this can't fail the commit (a retry would add another version)
+            try:
+                self._checksum_index.update_object(self.pid)
+            except (sqlite3.Error, InventoryError, ValueError, KeyError, OSError) as e:
+                self.index_error = f'{e.__class__.__name__}: {e}'
+        return self.version_num
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _read_inventory_digest(object_root):
+    try:
+        with open(os.path.join(object_root, 'inventory.json.sha512'), 'rb') as f:
+            return f.read().decode('utf8').split()[0]
+    except (FileNotFoundError, IndexError):
+        return None
+
+
+def _get_checksum_index_rows(storage_root, pid, known_digest):
+    '''returns (digest, rows) for the object, or None if its inventory digest hasn't changed'''
+    digest = _read_inventory_digest(object_path(storage_root, pid))
+    if digest and digest == known_digest:
+        return None
+    obj = Object(storage_root, pid, deleted_ok=True)
+    manifest = obj._inventory['manifest']
+    sizes = {}
+    rows = []
+    for version_num, version in obj._inventory['versions'].items():
+        for checksum, filepaths in version['state'].items():
+            content_path = manifest[checksum][0]
+            if checksum not in sizes:
+                sizes[checksum] = get_file_size(os.path.join(obj.object_path, content_path))
+            for filepath in filepaths:
+                rows.append((checksum, pid, version_num, filepath, content_path, sizes[checksum]))
+    return digest, rows
+
+
+class ChecksumIndex:
+    '''Persistent (sqlite) index of checksum -> (pid, version, logical path, content path, size),
+    for every file in every version of every object in the storage root.
+
+    update() re-reads only the objects whose root inventory digest (from inventory.json.sha512)
+    has changed since the last update, and drops objects that are gone.'''
+
+    def __init__(self, index_path, storage_root):
+        self.storage_root = storage_root
+        #the lock lets ObjectBuilder worker threads share the connection
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(index_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS objects (pid TEXT PRIMARY KEY, inventory_digest TEXT)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS content (checksum TEXT NOT NULL, pid TEXT NOT NULL, version TEXT NOT NULL, logical_path TEXT NOT NULL, content_path TEXT NOT NULL, size INTEGER NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS content_checksum ON content (checksum)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS content_pid ON content (pid)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS content_size ON content (size)')
+
+    def close(self):
+        self._conn.close()
+
+    def _store(self, pid, digest, rows):
+        #caller holds the lock & transaction
+        self._conn.execute('DELETE FROM content WHERE pid = ?', (pid,))
+        self._conn.executemany('INSERT INTO content VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self._conn.execute('INSERT OR REPLACE INTO objects VALUES (?, ?)', (pid, digest))
+
+    def _remove(self, pid):
+        self._conn.execute('DELETE FROM content WHERE pid = ?', (pid,))
+        self._conn.execute('DELETE FROM objects WHERE pid = ?', (pid,))
+
+    def update_object(self, pid):
+        try:
+            digest, rows = _get_checksum_index_rows(self.storage_root, pid, known_digest=None)
+        except ObjectNotFound:
+            with self._lock, self._conn:
+                self._remove(pid)
+            return
+        with self._lock, self._conn:
+            self._store(pid, digest, rows)
+
+    def update(self, max_workers=8, batch_size=1000):
+        '''bring the index up to date with the storage root - returns counts of updated & removed objects, and errors by pid'''
+        with self._lock:
+            known_digests = dict(self._conn.execute('SELECT pid, inventory_digest FROM objects'))
+        result = {'updated': 0, 'removed': 0, 'errors': {}}
+        seen_pids = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch in _batched(walk_repo(self.storage_root), batch_size):
+                futures = [(pid, executor.submit(_get_checksum_index_rows, self.storage_root, pid, known_digests.get(pid))) for pid in batch]
+                with self._lock, self._conn:
+                    for pid, future in futures:
+                        seen_pids.add(pid)
+                        try:
+                            index_info = future.result()
+                        except (ObjectNotFound, InventoryError, ValueError, KeyError, OSError) as e:
+                            result['errors'][pid] = f'{e.__class__.__name__}: {e}'
+                            continue
+                        if index_info:
+                            self._store(pid, *index_info)
+                            result['updated'] += 1
+        with self._lock, self._conn:
+            for pid in known_digests:
+                if pid not in seen_pids:
+                    self._remove(pid)
+                    result['removed'] += 1
+        return result
+
+    def lookup(self, checksum):
+        with self._lock:
+            cursor = self._conn.execute('SELECT pid, version, logical_path, content_path, size FROM content WHERE checksum = ? ORDER BY pid, version, logical_path', (checksum,))
+            return [
+                    {'pid': pid, 'version': version, 'logicalPath': logical_path, 'contentPath': content_path, 'size': size}
+                    for pid, version, logical_path, content_path, size in cursor
+                ]
+
+    def object_sizes(self, pid, inventory_digest):
+        '''sizes of the object's content, or None if the index isn't up to date with that inventory digest'''
+        with self._lock:
+            row = self._conn.execute('SELECT inventory_digest FROM objects WHERE pid = ?', (pid,)).fetchone()
+            if not (row and inventory_digest and row[0] == inventory_digest):
+                return None
+            return {size for (size,) in self._conn.execute('SELECT DISTINCT size FROM content WHERE pid = ?', (pid,))}
+
+    def has_size(self, size):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM content WHERE size = ? LIMIT 1', (size,)).fetchone() is not None
+
+    def find_content_path(self, checksum):
+        '''full path to an existing content file with this checksum (and the indexed size), or None'''
+        with self._lock:
+            locations = self._conn.execute('SELECT DISTINCT pid, content_path, size FROM content WHERE checksum = ?', (checksum,)).fetchall()
+        for pid, content_path, size in locations:
+            full_path = os.path.join(object_path(self.storage_root, pid), content_path)
+            try:
+                if get_file_size(full_path) == size:
+                    return full_path
+            except FileNotFoundError:
+                pass
+
+    def duplicates(self):
+        '''content stored in more than one object: yields checksum, size, and pids'''
+        with self._lock:
+            rows = self._conn.execute(
+                    'SELECT checksum, MAX(size), GROUP_CONCAT(DISTINCT pid) FROM content GROUP BY checksum HAVING COUNT(DISTINCT pid) > 1 ORDER BY checksum'
+                ).fetchall()
+        for checksum, size, pids in rows:
+            yield {'checksum': checksum, 'size': size, 'pids': sorted(pids.split(','))}
+
+
+def changed_since(storage_root, since, top_ntuple_segment=None):
+    '''generate info for the objects changed at/after since (a timezone-aware datetime, or None for all objects)
+
+    The root inventory.json mtime is checked first, so unchanged objects are skipped without
+    parsing their inventory. Objects without a root inventory are parsed & checked by lastModified.
+    Objects that can't be loaded are generated as {'pid': pid, 'error': message}, instead of
+    stopping the feed.'''
+    since_timestamp = since.timestamp() if since else None
+    for pid in walk_repo(storage_root, top_ntuple_segment=top_ntuple_segment):
+        try:
+            mtime = os.stat(os.path.join(object_path(storage_root, pid), 'inventory.json')).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if since_timestamp and mtime is not None and mtime < since_timestamp:
+            continue
+        try:
+            obj = Object(storage_root, pid, deleted_ok=True)
+            if since and mtime is None and obj.last_modified < since:
+                continue
+            change = {
+                    'pid': pid,
+                    'headVersion': obj.head_version,
+                    'lastModified': obj.last_modified,
+                    'deleted': not obj._inventory['versions'][obj.head_version]['state'],
+                }
+        except ObjectNotFound:
+            #removed since walk_repo listed it
+            continue
+        except (InventoryError, DateTimeError, ValueError, KeyError, OSError) as e:
+            change = {'pid': pid, 'error': f'{e.__class__.__name__}: {e}'}
+        yield change
+
+
+class ChangeFeed:
+    '''changed_since() with a cursor saved to a file, so each run only sees the objects changed since the last run
+
+        feed = ChangeFeed(storage_root, '/var/lib/reindexer/cursor.json')
+        for change in feed.changes():
+            reindex(change['pid'])
+        feed.save()
+
+    The cursor is the time the last run started. overlap is subtracted from it, to allow
+    for clock differences between this host and the storage server - so some objects
+    may be seen in two consecutive runs.'''
+
+    def __init__(self, storage_root, cursor_path, overlap=timedelta(minutes=5)):
+        self.storage_root = storage_root
+        self.cursor_path = cursor_path
+        self.overlap = overlap
+        self._run_started = None
+
+    @property
+    def cursor(self):
+        try:
+            with open(self.cursor_path, 'rb') as f:
+                data = json.loads(f.read().decode('utf8'))
+        except FileNotFoundError:
+            return None
+        return utc_datetime_from_string(data['since'])
+
+    def changes(self, top_ntuple_segment=None):
+        self._run_started = datetime.now(timezone.utc)
+        since = self.cursor
+        if since:
+            since = since - self.overlap
+        return changed_since(self.storage_root, since, top_ntuple_segment=top_ntuple_segment)
+
+    def save(self):
+        '''record that all the changes from the current run have been processed'''
+        if not self._run_started:
+            raise RuntimeError('no changes() run to save')
+        data = {'since': self._run_started.isoformat()}
+        _write_file_atomically(self.cursor_path, json.dumps(data).encode('utf8'))
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+INVENTORY_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+#statfs f_type values of network/cluster filesystems - inotify doesn't see changes made on other hosts
+NETWORK_FILESYSTEM_TYPES = {
+        0x6969, #nfs
+        0x517B, #smb
+        0xFF534D42, #cifs
+        0xFE534D42, #smb2
+        0x65735546, #fuse (sshfs, s3fs, ...)
+        0x00C36400, #ceph
+        0x5346414F, #afs
+        0x01021997, #9p
+        0x01161970, #gfs2
+        0x7461636F, #ocfs2
+        0x0BD00BD0, #lustre
+        0x47504653, #gpfs
+    }
+
+
+def _is_network_filesystem(path):
+    '''True if path is on a network filesystem (or if we can't tell)'''
+    try:
+        statfs = ctypes.CDLL(None, use_errno=True).statfs
+    except (OSError, AttributeError):
+        return True
+    #f_type is the first field of struct statfs - the buffer is bigger than the whole struct
+    buf = ctypes.create_string_buffer(256)
+    if statfs(os.fsencode(path), buf) != 0:
+        return True
+    return (ctypes.c_long.from_buffer(buf).value & 0xFFFFFFFF) in NETWORK_FILESYSTEM_TYPES
+
+
+class InventoryWatcher:
+    '''Watch object directories with Linux inotify, and report the objects whose root inventory.json was written, replaced or removed.
+
+    Raises OSError if inotify isn't available.'''
+
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self._libc = libc
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._wd_paths = {}
+        self._path_wds = {}
+        self.watch_failures = 0
+
+    def close(self):
+        os.close(self._fd)
+
+    def watch(self, object_root):
+        '''returns False if the directory couldn't be watched (eg. the max_user_watches limit was reached)'''
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(object_root), INVENTORY_WATCH_MASK)
+        if wd < 0:
+            if ctypes.get_errno() != errno.ENOENT:
+                self.watch_failures += 1
+            return False
+        self._wd_paths[wd] = object_root
+        self._path_wds[object_root] = wd
+        return True
+
+    def unwatch(self, object_root):
+        wd = self._path_wds.pop(object_root, None)
+        if wd is not None:
+            self._wd_paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def is_watched(self, object_root):
+        return object_root in self._path_wds
+
+    def watch_storage_root(self, storage_root):
+        '''watch every object in the storage root - returns the number of objects watched'''
+        num_watched = 0
+        for pid in walk_repo(storage_root):
+            if self.watch(object_path(storage_root, pid)):
+                num_watched += 1
+        return num_watched
+
+    def read_changes(self):
+        '''returns (set of changed object roots, whether events were lost) - doesn't block'''
+        changed = set()
+        overflowed = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = data[offset:offset + name_len].rstrip(b'\0')
+                offset += name_len
+                if mask & IN_Q_OVERFLOW:
+                    overflowed = True
+                    continue
+                object_root = self._wd_paths.get(wd)
+                if not object_root:
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    changed.add(object_root)
+                    if mask & IN_IGNORED:
+                        #the kernel already removed the watch
+                        del self._wd_paths[wd]
+                        self._path_wds.pop(object_root, None)
+                elif name == b'inventory.json':
+                    changed.add(object_root)
+        return changed, overflowed
+
+
+class ObjectCache:
+    '''LRU cache of Object instances (including their lazily loaded files info & RELS-INT),
+    invalidated when an object's root inventory.json changes.
+
+    With inotify (Linux), cached objects are watched, and only re-checked when an event comes in.
+    Objects that can't be watched (eg. the inotify watch limit was reached), or all objects if
+    inotify isn't available, are validated with a stat of their root inventory.json on each access.
+    inotify only sees changes made on this host, so it's only used if the storage root is on a
+    local filesystem - on NFS, CIFS, etc., every access is stat-validated.'''
+
+    def __init__(self, storage_root, max_objects=10000, inotify=True, fallback_to_version_directory=True, content_cache=None):
+        self.storage_root = storage_root
+        self._content_cache = content_cache
+        self.max_objects = max_objects
+        self._fallback_to_version_directory = fallback_to_version_directory
+        self.watcher = None
+        if inotify and not _is_network_filesystem(storage_root):
+            try:
+                self.watcher = InventoryWatcher()
+            except OSError:
+                pass
+        self._lock = threading.Lock()
+        #pid -> (obj, inventory stat signature or None if watched)
+        self._entries = OrderedDict()
+        self._object_root_pids = {}
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'statValidations': 0}
+
+    @property
+    def stats(self):
+        stats = dict(self._stats)
+        stats['watchFailures'] = self.watcher.watch_failures if self.watcher else 0
+        return stats
+
+    def close(self):
+        if self.watcher:
+            self.watcher.close()
+
+    @staticmethod
+    def _stat_signature(object_root):
+        try:
+            st = os.stat(os.path.join(object_root, 'inventory.json'))
+        except FileNotFoundError:
+            return 'missing'
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _remove(self, pid, unwatch=True):
+        #caller holds the lock
+        obj, _ = self._entries.pop(pid)
+        self._object_root_pids.pop(obj.object_path, None)
+        if self.watcher and unwatch:
+            self.watcher.unwatch(obj.object_path)
+
+    def invalidate(self, pid):
+        with self._lock:
+            if pid in self._entries:
+                self._remove(pid)
+                self._stats['invalidations'] += 1
+
+    def _process_watch_events(self):
+        #caller holds the lock
+        changed, overflowed = self.watcher.read_changes()
+        if overflowed:
+            changed = list(self._object_root_pids.keys())
+        for object_root in changed:
+            pid = self._object_root_pids.get(object_root)
+            if pid in self._entries:
+                self._remove(pid)
+                self._stats['invalidations'] += 1
+
+    def _get_cached(self, pid):
+        with self._lock:
+            if self.watcher:
+                self._process_watch_events()
+            if pid not in self._entries:
+                return None
+            obj, signature = self._entries[pid]
+            if signature is not None:
+                self._stats['statValidations'] += 1
+                if ObjectCache._stat_signature(obj.object_path) != signature:
+                    self._remove(pid)
+                    self._stats['invalidations'] += 1
+                    return None
+            self._entries.move_to_end(pid)
+            self._stats['hits'] += 1
+            return obj
+
+    def get(self, pid, deleted_ok=False):
+        obj = self._get_cached(pid)
+        if not obj:
+            root = object_path(self.storage_root, pid)
+            #watch/stat before reading the inventory, so a change while we're reading it isn't missed
+            if self.watcher:
+                with self._lock:
+                    self.watcher.watch(root)
+            signature = ObjectCache._stat_signature(root)
+            try:
+                obj = Object(self.storage_root, pid, fallback_to_version_directory=self._fallback_to_version_directory, deleted_ok=True, content_cache=self._content_cache)
+            except Exception:
+                if self.watcher:
+                    with self._lock:
+                        if pid not in self._entries:
+                            self.watcher.unwatch(root)
+                raise
+            with self._lock:
+                self._stats['misses'] += 1
+                if pid in self._entries:
+                    #another thread loaded it at the same time - the watch is shared, so keep it
+                    self._remove(pid, unwatch=False)
+                #check the watch now, since another thread could have removed it while we were loading
+                watched = bool(self.watcher) and self.watcher.is_watched(root)
+                self._entries[pid] = (obj, None if watched else signature)
+                self._object_root_pids[obj.object_path] = pid
+                while len(self._entries) > self.max_objects:
+                    self._remove(next(iter(self._entries)))
+            #watch events that came in while we were loading were dropped (the root wasn't mapped to
+            #the pid yet), so check once more that the inventory didn't change
+            if watched and ObjectCache._stat_signature(root) != signature:
+                self.invalidate(pid)
+        if not (deleted_ok or obj._inventory['versions'][obj.head_version]['state']):
+            raise ObjectDeleted(f'{pid} deleted')
+        return obj
+
+
+def _storage_root_shards(storage_root):
+    #the top-level n-tuple directories - each one is handled as a unit of work
+    shards = []
+    with os.scandir(storage_root) as it:
+        for entry in it:
+            if entry.is_dir() and entry.name != 'extensions':
+                shards.append(entry.name)
+    return sorted(shards)
+
+
+def _empty_repo_stats():
+    return {
+            'objects': 0,
+            'deletedObjects': 0,
+            'totalBytes': 0, #bytes of content stored
+            'versionBytes': 0, #bytes of content in all the versions' states
+            'addedBytes': 0, #bytes of content added or changed in each version - what we'd store without dedup
+            'bytesByMimetype': {},
+            'versionCounts': {}, #number of versions -> number of objects
+            'errors': {},
+        }
+
+
+def _merge_repo_stats(stats, partial_stats):
+    for key in ['objects', 'deletedObjects', 'totalBytes', 'versionBytes', 'addedBytes']:
+        stats[key] += partial_stats[key]
+    for key in ['bytesByMimetype', 'versionCounts']:
+        for value, count in partial_stats[key].items():
+            stats[key][value] = stats[key].get(value, 0) + count
+    stats['errors'].update(partial_stats['errors'])
+
+
+def _get_object_stats(storage_root, pid):
+    stats = _empty_repo_stats()
+    obj = Object(storage_root, pid, deleted_ok=True)
+    inventory = obj._inventory
+    sizes = {}
+    mimetypes_by_checksum = {}
+    previous_path_checksums = {}
+    for version_num in reversed(Object.reversed_version_numbers(obj.head_version)):
+        path_checksums = {}
+        for checksum, filepaths in inventory['versions'][version_num]['state'].items():
+            if checksum not in sizes:
+                sizes[checksum] = get_file_size(os.path.join(obj.object_path, inventory['manifest'][checksum][0]))
+            #categorize content by the newest filename it has
+            mimetypes_by_checksum[checksum] = get_mimetype_from_filename(filepaths[0])
+            stats['versionBytes'] += sizes[checksum] * len(filepaths)
+            for filepath in filepaths:
+                path_checksums[filepath] = checksum
+                #files carried over unchanged from the previous version wouldn't be stored again, even without dedup
+                if previous_path_checksums.get(filepath) != checksum:
+                    stats['addedBytes'] += sizes[checksum]
+        previous_path_checksums = path_checksums
+    for checksum, content_paths in inventory['manifest'].items():
+        if checksum not in sizes:
+            sizes[checksum] = get_file_size(os.path.join(obj.object_path, content_paths[0]))
+            mimetypes_by_checksum[checksum] = get_mimetype_from_filename(content_paths[0].split('/')[-1])
+        content_bytes = sizes[checksum] * len(content_paths)
+        stats['totalBytes'] += content_bytes
+        mimetype = mimetypes_by_checksum[checksum]
+        stats['bytesByMimetype'][mimetype] = stats['bytesByMimetype'].get(mimetype, 0) + content_bytes
+    stats['objects'] += 1
+    if not inventory['versions'][obj.head_version]['state']:
+        stats['deletedObjects'] += 1
+    num_versions = str(len(inventory['versions']))
+    stats['versionCounts'][num_versions] = stats['versionCounts'].get(num_versions, 0) + 1
+    return stats
+
+
+def _shard_stats(storage_root, shard):
+    stats = _empty_repo_stats()
+    for pid in walk_repo(storage_root, top_ntuple_segment=shard):
+        #each object's stats are only merged once they're complete, so an error doesn't leave partial totals
+        try:
+            object_stats = _get_object_stats(storage_root, pid)
+        except (ObjectNotFound, InventoryError, ValueError, KeyError, OSError) as e:
+            stats['errors'][pid] = f'{e.__class__.__name__}: {e}'
+            continue
+        _merge_repo_stats(stats, object_stats)
+    return stats
+
+
+def repo_stats(storage_root, max_workers=None, checkpoint_path=None):
+    '''storage statistics for the whole repo, calculated from inventories & file stats (content isn't read)
+
+    Each top-level n-tuple directory is handled in a separate process. If checkpoint_path is given,
+    the merged results are saved there after each directory finishes, and a rerun picks up where
+    the last one stopped.'''
+    stats = _empty_repo_stats()
+    completed_shards = []
+    if checkpoint_path:
+        try:
+            with open(checkpoint_path, 'rb') as f:
+                checkpoint = json.loads(f.read().decode('utf8'))
+            stats = checkpoint['stats']
+            completed_shards = checkpoint['completedShards']
+        except FileNotFoundError:
+            pass
+    shards = [shard for shard in _storage_root_shards(storage_root) if shard not in completed_shards]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_shard_stats, storage_root, shard): shard for shard in shards}
+        for future in as_completed(futures):
+            _merge_repo_stats(stats, future.result())
+            completed_shards.append(futures[future])
+            if checkpoint_path:
+                checkpoint = {'completedShards': completed_shards, 'stats': stats}
+                _write_file_atomically(checkpoint_path, json.dumps(checkpoint).encode('utf8'))
+    stats['dedupSavings'] = stats['addedBytes'] - stats['totalBytes']
+    return stats
+
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+ZIP_CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+ZIP_END_RECORD = struct.Struct('<4s4H2LH')
+ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_END_LOCATOR = struct.Struct('<4sLQL')
+ZIP_FLAGS = 0x0008 | 0x0800 #sizes & crc in a data descriptor after the data; utf-8 filenames
+
+
+class VersionArchive:
+    '''Stream a zip (stored, not compressed) or tar archive of the files in a version of an object.
+
+    Entries are named with the downloadFilename from that version's RELS-INT. The archive is
+    generated on the fly from the content files (no temp files), and its size is known up front:
+
+        archive = VersionArchive(obj, archive_format='zip')
+        response = StreamingHttpResponse(archive, content_type=archive.content_type)
+        response['Content-Length'] = archive.size'''
+
+    def __init__(self, obj, version=None, archive_format='zip'):
+        if archive_format not in ['zip', 'tar']:
+            raise ValueError(f'invalid archive format: {archive_format}')
+        self.archive_format = archive_format
+        self.version = version or obj.head_version
+        self.content_type = 'application/zip' if archive_format == 'zip' else 'application/x-tar'
+        self.filename = f'{obj.pid.replace(":", "_")}_{self.version}.{archive_format}'
+        self._created = utc_datetime_from_string(obj._inventory['versions'][self.version]['created'])
+        if self.version == obj.head_version:
+            rels_int_root = obj.rels_int_root
+        else:
+            rels_int_root = obj._get_rels_int_root(self.version)
+        manifest = obj._inventory['manifest']
+        filepath_checksums = {}
+        for checksum, filepaths in obj._inventory['versions'][self.version]['state'].items():
+            for filepath in filepaths:
+                filepath_checksums[filepath] = checksum
+        #(entry name, full path, size)
+        self._entries = []
+        used_names = set()
+        for filepath, checksum in sorted(filepath_checksums.items()):
+            name = get_download_filename_from_rels_int(rels_int_root, obj.pid, filepath)
+            if not name or name in used_names:
+                name = filepath
+            unique_name = name
+            n = 1
+            while unique_name in used_names:
+                unique_name = f'{name}_{n}'
+                n += 1
+            used_names.add(unique_name)
+            full_path = os.path.join(obj.object_path, manifest[checksum][0])
+            self._entries.append((unique_name, full_path, get_file_size(full_path)))
+
+    def _dos_date_time(self):
+        created = self._created
+        if created.year < 1980:
+            return 0, (1 << 5) | 1
+        dos_time = (created.hour << 11) | (created.minute << 5) | (created.second // 2)
+        dos_date = ((created.year - 1980) << 9) | (created.month << 5) | created.day
+        return dos_time, dos_date
+
+    def _zip_parts(self, crcs):
+        '''yields bytes, or (entry index, full path, size) where the file data goes
+
+        crcs should be filled in by the caller as file data is streamed - the layout
+        (and so the size) doesn't depend on the crc values.'''
+        dos_time, dos_date = self._dos_date_time()
+        offset = 0
+        offsets = []
+        for index, (name, full_path, size) in enumerate(self._entries):
+            encoded_name = name.encode('utf8')
+            offsets.append(offset)
+            if size >= ZIP64_LIMIT:
+                extra = struct.pack('<2H2Q', 1, 16, 0, 0)
+                version_needed = 45
+                header_size = ZIP64_LIMIT
+                descriptor_struct = '<4sL2Q'
+            else:
+                extra = b''
+                version_needed = 20
+                header_size = 0
+                descriptor_struct = '<4s3L'
+            header = ZIP_LOCAL_HEADER.pack(b'PK\x03\x04', version_needed, ZIP_FLAGS, 0, dos_time, dos_date, 0, header_size, header_size, len(encoded_name), len(extra)) + encoded_name + extra
+            yield header
+            yield (index, full_path, size)
+            descriptor = struct.pack(descriptor_struct, b'PK\x07\x08', crcs.get(index, 0), size, size)
+            yield descriptor
+            offset += len(header) + size + len(descriptor)
+        central_directory_offset = offset
+        for index, (name, full_path, size) in enumerate(self._entries):
+            encoded_name = name.encode('utf8')
+            zip64_fields = []
+            if size >= ZIP64_LIMIT:
+                zip64_fields.extend([size, size])
+            if offsets[index] >= ZIP64_LIMIT:
+                zip64_fields.append(offsets[index])
+            if zip64_fields:
+                extra = struct.pack(f'<2H{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields)
+                version_needed = 45
+            else:
+                extra = b''
+                version_needed = 20
+            header = ZIP_CENTRAL_HEADER.pack(
+                    b'PK\x01\x02', 45, version_needed, ZIP_FLAGS, 0, dos_time, dos_date,
+                    crcs.get(index, 0), min(size, ZIP64_LIMIT), min(size, ZIP64_LIMIT), len(encoded_name), len(extra), 0, 0, 0,
+                    0o100644 << 16, min(offsets[index], ZIP64_LIMIT),
+                ) + encoded_name + extra
+            yield header
+            offset += len(header)
+        central_directory_size = offset - central_directory_offset
+        num_entries = len(self._entries)
+        if num_entries >= 0xFFFF or central_directory_size >= ZIP64_LIMIT or central_directory_offset >= ZIP64_LIMIT:
+            yield ZIP64_END_RECORD.pack(b'PK\x06\x06', ZIP64_END_RECORD.size - 12, 45, 45, 0, 0, num_entries, num_entries, central_directory_size, central_directory_offset)
+            yield ZIP64_END_LOCATOR.pack(b'PK\x06\x07', 0, offset, 1)
+        yield ZIP_END_RECORD.pack(b'PK\x05\x06', 0, 0, min(num_entries, 0xFFFF), min(num_entries, 0xFFFF), min(central_directory_size, ZIP64_LIMIT), min(central_directory_offset, ZIP64_LIMIT), 0)
+
+    def _tar_parts(self, crcs):
+        mtime = self._created.timestamp()
+        for index, (name, full_path, size) in enumerate(self._entries):
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = size
+            tar_info.mtime = mtime
+            tar_info.mode = 0o644
+            yield tar_info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+            yield (index, full_path, size)
+            if size % tarfile.BLOCKSIZE:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+        yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+    def _parts(self, crcs):
+        if self.archive_format == 'zip':
+            return self._zip_parts(crcs)
+        return self._tar_parts(crcs)
+
+    @property
+    def size(self):
+        return sum(part[2] if isinstance(part, tuple) else len(part) for part in self._parts({}))
+
+    def __iter__(self):
+        crcs = {}
+        for part in self._parts(crcs):
+            if isinstance(part, tuple):
+                index, full_path, size = part
+                crc = 0
+                bytes_read = 0
+                with open(full_path, 'rb') as f:
+                    while True:
+                        chunk = f.read(ARCHIVE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        crc = zlib.crc32(chunk, crc)
+                        bytes_read += len(chunk)
+                        yield chunk
+                if bytes_read != size:
+                    raise FixityError(f'{full_path}: read {bytes_read} bytes; expected {size}')
+                #the zip generator reads this when it resumes, for the descriptor & central directory
+                crcs[index] = crc
+            else:
+                yield part
+
+
+def _list_content_files(version_path, version_num):
+    #content paths (as they'd appear in the manifest) of all the files under the version's content directory,
+    #and any empty directories in it
+    content_paths = []
+    empty_directories = []
+    directories = [(os.path.join(version_path, 'content'), f'{version_num}/content')]
+    while directories:
+        directory, relative_directory = directories.pop()
+        try:
+            with os.scandir(directory) as it:
+                is_empty = True
+                for entry in it:
+                    is_empty = False
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append((entry.path, f'{relative_directory}/{entry.name}'))
+                    else:
+                        content_paths.append(f'{relative_directory}/{entry.name}')
+        except FileNotFoundError:
+            continue
+        if is_empty:
+            empty_directories.append(relative_directory)
+    return content_paths, empty_directories
+
+
+def validate_object(storage_root, pid):
+    '''check an object's structure against its inventories, without reading any content
+
+    Returns a list of errors, each a dict with a machine-readable 'code' and a 'message'.'''
+    errors = []
+
+    def add_error(code, message):
+        errors.append({'code': code, 'message': message})
+
+    root = object_path(storage_root, pid)
+    try:
+        with os.scandir(root) as it:
+            root_entries = {entry.name: entry.is_dir() for entry in it}
+    except FileNotFoundError:
+        add_error('object_not_found', f'{pid} not found')
+        return errors
+    if OBJECT_DECLARATION not in root_entries:
+        add_error('object_declaration_missing', f'{pid} has no {OBJECT_DECLARATION} file')
+    else:
+        with open(os.path.join(root, OBJECT_DECLARATION), 'rb') as f:
+            if f.read() != OBJECT_DECLARATION_CONTENT:
+                add_error('object_declaration_invalid', f'{OBJECT_DECLARATION} doesn\'t contain {OBJECT_DECLARATION_CONTENT!r}')
+    if 'inventory.json' not in root_entries:
+        add_error('root_inventory_missing', f'{pid} has no root inventory.json')
+        return errors
+    with open(os.path.join(root, 'inventory.json'), 'rb') as f:
+        inventory_bytes = f.read()
+    try:
+        inventory = json.loads(inventory_bytes.decode('utf8'))
+    except ValueError as e:
+        add_error('inventory_invalid_json', f'root inventory.json: {e}')
+        return errors
+    if not isinstance(inventory, dict):
+        add_error('inventory_invalid_type', f'root inventory.json is a {type(inventory).__name__}, not an object')
+        return errors
+    recorded_digest = _read_inventory_digest(root)
+    if not recorded_digest:
+        add_error('inventory_digest_missing', 'no root inventory.json.sha512')
+    elif hashlib.sha512(inventory_bytes).hexdigest() != recorded_digest:
+        add_error('inventory_digest_mismatch', f'root inventory.json doesn\'t match recorded digest {recorded_digest}')
+    missing_fields = [field for field in ['id', 'type', 'digestAlgorithm', 'head', 'manifest', 'versions'] if field not in inventory]
+    if missing_fields:
+        add_error('inventory_missing_fields', f'root inventory.json missing: {", ".join(missing_fields)}')
+        if set(missing_fields) & {'head', 'manifest', 'versions'}:
+            return errors
+    if 'id' in inventory and inventory['id'] != pid:
+        add_error('inventory_id_mismatch', f'inventory id {inventory["id"]} != {pid}')
+    if inventory.get('digestAlgorithm', 'sha512') != 'sha512':
+        add_error('unsupported_digest_algorithm', f'digestAlgorithm {inventory["digestAlgorithm"]}')
+
+    if not isinstance(inventory['manifest'], dict):
+        add_error('invalid_manifest', f'manifest is a {type(inventory["manifest"]).__name__}, not an object')
+        return errors
+    if not isinstance(inventory['versions'], dict):
+        add_error('invalid_versions', f'versions is a {type(inventory["versions"]).__name__}, not an object')
+        return errors
+    #only the well-formed manifest entries & versions are checked further
+    manifest = {}
+    for checksum, content_paths in inventory['manifest'].items():
+        if isinstance(content_paths, list) and all(isinstance(content_path, str) for content_path in content_paths):
+            manifest[checksum] = content_paths
+        else:
+            add_error('invalid_manifest_entry', f'manifest entry for {checksum} isn\'t a list of paths: {content_paths!r}')
+    versions = inventory['versions']
+    valid_versions = {}
+    for version_num, version in sorted(versions.items()):
+        if not isinstance(version, dict):
+            add_error('invalid_version', f'{version_num} is a {type(version).__name__}, not an object')
+            continue
+        state = version.get('state')
+        if not isinstance(state, dict) or not all(isinstance(filepaths, list) for filepaths in state.values()):
+            add_error('invalid_version_state', f'{version_num} state isn\'t an object of checksum -> list of paths')
+            continue
+        valid_versions[version_num] = version
+
+    #versions must be v1..vN, with vN the head
+    try:
+        version_ints = sorted(int(version_num[1:]) for version_num in versions)
+    except ValueError:
+        add_error('invalid_version_number', f'invalid version number in {sorted(versions)}')
+        return errors
+    missing_versions = [f'v{i}' for i in range(1, max(version_ints or [0]) + 1) if f'v{i}' not in versions]
+    if not versions:
+        add_error('no_versions', 'inventory has no versions')
+    elif missing_versions:
+        add_error('version_sequence_gap', f'missing versions: {", ".join(missing_versions)}')
+    if version_ints and inventory['head'] != f'v{version_ints[-1]}':
+        add_error('head_version_mismatch', f'head {inventory["head"]} is not the latest version v{version_ints[-1]}')
+
+    version_dirs = {name for name, is_dir in root_entries.items() if is_dir and name.startswith('v')}
+    for version_num in sorted(versions):
+        if version_num not in version_dirs:
+            add_error('version_directory_missing', f'no {version_num} directory')
+    for version_dir in sorted(version_dirs - set(versions)):
+        add_error('unexpected_version_directory', f'{version_dir} directory isn\'t in the inventory')
+
+    content_on_disk = set()
+    for version_dir in version_dirs:
+        content_paths, empty_directories = _list_content_files(os.path.join(root, version_dir), version_dir)
+        content_on_disk.update(content_paths)
+        for empty_directory in sorted(empty_directories):
+            add_error('empty_content_directory', f'{empty_directory} is an empty directory')
+    for version_num in sorted(version_dirs & set(versions)):
+        version_path = os.path.join(root, version_num)
+        try:
+            with open(os.path.join(version_path, 'inventory.json'), 'rb') as f:
+                version_inventory_bytes = f.read()
+        except FileNotFoundError:
+            if version_num == inventory['head']:
+                add_error('version_inventory_missing', f'no {version_num} inventory.json')
+            continue
+        if version_num == inventory['head']:
+            if version_inventory_bytes != inventory_bytes:
+                add_error('version_inventory_mismatch', f'{version_num} inventory.json isn\'t identical to the root inventory.json')
+            continue
+        try:
+            version_inventory = json.loads(version_inventory_bytes.decode('utf8'))
+        except ValueError as e:
+            add_error('inventory_invalid_json', f'{version_num} inventory.json: {e}')
+            continue
+        if not isinstance(version_inventory, dict) or not isinstance(version_inventory.get('versions', {}), dict):
+            add_error('inventory_invalid_type', f'{version_num} inventory.json isn\'t an object with a versions object')
+            continue
+        for older_version_num, older_version in version_inventory.get('versions', {}).items():
+            if versions.get(older_version_num) != older_version:
+                add_error('version_inventory_mismatch', f'{version_num} inventory.json has a different {older_version_num} than the root inventory.json')
+
+    manifest_paths = set()
+    for checksum, content_paths in manifest.items():
+        for content_path in content_paths:
+            manifest_paths.add(content_path)
+            if content_path not in content_on_disk:
+                add_error('manifest_file_missing', f'{content_path} is in the manifest but doesn\'t exist')
+    for content_path in sorted(content_on_disk - manifest_paths):
+        add_error('orphan_content_file', f'{content_path} isn\'t in the manifest')
+    for version_num, version in sorted(valid_versions.items()):
+        for checksum in version['state']:
+            if checksum not in manifest:
+                add_error('state_checksum_not_in_manifest', f'{version_num} state checksum {checksum} isn\'t in the manifest')
+        created = version.get('created')
+        try:
+            if not isinstance(created, str):
+                raise DateTimeError(f'created is a {type(created).__name__}')
+            utc_datetime_from_string(created)
+        except DateTimeError:
+            add_error('invalid_created_date', f'{version_num} created: {created!r}')
+    return errors
+
+
+def _validate_shard(storage_root, shard):
+    invalid = []
+    for pid in walk_repo(storage_root, top_ntuple_segment=shard):
+        try:
+            errors = validate_object(storage_root, pid)
+        except Exception as e:
+            #don't let one object we couldn't handle stop the whole run
+            errors = [{'code': 'validation_error', 'message': f'{e.__class__.__name__}: {e}'}]
+        if errors:
+            invalid.append((pid, errors))
+    return invalid
+
+
+def validate_storage_root(storage_root, max_workers=None):
+    '''validate every object in the storage root, in a process pool - generates (pid, errors) for the invalid objects'''
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_validate_shard, storage_root, shard) for shard in _storage_root_shards(storage_root)]
+        for future in as_completed(futures):
+            for pid, errors in future.result():
+                yield pid, errors
+
+
+class ContentCache:
+    '''Read-through cache of content files in a local directory (eg. on SSD), keyed by checksum.
+
+    Content never changes for a checksum, so cached files don't need invalidating. The least recently
+    used files are evicted when the cache goes over max_bytes, and concurrent requests for the same
+    uncached content wait for a single copy. Files bigger than max_file_bytes aren't cached. Pass it to
+    Object (or ObjectCache) to have get_path_to_file() and open_file() use the cache:
+
+        content_cache = ContentCache('/ssd/ocfl_cache', max_bytes=50_000_000_000)
+        obj = Object(storage_root, pid, content_cache=content_cache)
+
+    The LRU bookkeeping is per-process - processes sharing a cache directory each evict
+    based on what they've cached (plus what was there when they started).'''
+
+    def __init__(self, cache_dir, max_bytes, max_file_bytes=100_000_000):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        #bigger files are served from the storage root, instead of being copied (& fsynced) on the first request
+        self.max_file_bytes = max_file_bytes
+        self._lock = threading.Lock()
+        #checksum -> size, least recently used first
+        self._entries = OrderedDict()
+        #checksum -> Event, for copies in progress
+        self._fills = {}
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bypasses': 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        existing = []
+        for dir_path, _, filenames in os.walk(cache_dir):
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                st = os.stat(path)
+                if filename.endswith('.tmp'):
+                    #leftover from an interrupted copy (but another process could be copying now)
+                    if st.st_mtime < time.time() - 3600:
+                        os.remove(path)
+                    continue
+                existing.append((st.st_atime, filename, st.st_size))
+        for _, checksum, size in sorted(existing):
+            self._entries[checksum] = size
+            self._bytes += size
+        with self._lock:
+            self._evict()
+
+    @property
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['bytes'] = self._bytes
+            stats['files'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hitRate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _path(self, checksum):
+        return os.path.join(self.cache_dir, checksum[0:2], checksum[2:4], checksum)
+
+    def _evict(self, keep=None):
+        #caller holds the lock
+        for checksum in list(self._entries.keys()):
+            if self._bytes <= self.max_bytes:
+                break
+            if checksum == keep:
+                continue
+            self._bytes -= self._entries.pop(checksum)
+            self._stats['evictions'] += 1
+            try:
+                os.remove(self._path(checksum))
+            except FileNotFoundError:
+                pass
+
+    def _use(self, path, open_file):
+        #caller holds the lock, so the file can't be evicted before it's opened
+        if open_file:
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                return None
+        if os.path.exists(path):
+            return path
+
+    def _get(self, checksum, source_path, open_file):
+        while True:
+            with self._lock:
+                if checksum in self._entries:
+                    result = self._use(self._path(checksum), open_file)
+                    if result:
+                        self._entries.move_to_end(checksum)
+                        self._stats['hits'] += 1
+                        return result
+                    #removed from outside this process
+                    self._bytes -= self._entries.pop(checksum)
+                fill = self._fills.get(checksum)
+                if not fill:
+                    fill = threading.Event()
+                    self._fills[checksum] = fill
+                    self._stats['misses'] += 1
+                    break
+            #another thread is copying this content - wait for it, then look again
+            fill.wait()
+        try:
+            size = get_file_size(source_path)
+            if size > min(self.max_bytes, self.max_file_bytes):
+                with self._lock:
+                    self._stats['bypasses'] += 1
+                return open(source_path, 'rb') if open_file else source_path
+            path = self._path(checksum)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file_checksum = _copy_and_hash(source_path, path)
+            if file_checksum != checksum:
+                os.remove(path)
+                raise FixityError(f'{source_path}: calculated={file_checksum}; recorded={checksum}')
+            with self._lock:
+                self._entries[checksum] = size
+                self._bytes += size
+                self._evict(keep=checksum)
+                return self._use(path, open_file)
+        finally:
+            with self._lock:
+                del self._fills[checksum]
+            fill.set()
+
+    def get_path(self, checksum, source_path):
+        '''path to the cached copy of the content, copying it from source_path first if needed
+
+        Another thread's copy can evict the file before the caller opens the path - use open_file()
+        if that matters.'''
+        return self._get(checksum, source_path, open_file=False)
+
+    def open_file(self, checksum, source_path):
+        '''binary file object for the cached copy of the content, copying it from source_path first if needed
+
+        The file is opened before it can be evicted, so reads are safe even if it's removed from the cache.'''
+        return self._get(checksum, source_path, open_file=True)
@@ -28,15 +28,18 @@ def write_inventory_files(object_root, inventory):
     version_root = os.path.join(object_root, inventory['head'])
     if not os.path.exists(version_root):
         os.makedirs(version_root, exist_ok=True)
+    with open(os.path.join(object_root, ocfl.OBJECT_DECLARATION), 'wb') as f:
+        f.write(ocfl.OBJECT_DECLARATION_CONTENT)
     inventory_path = os.path.join(object_root, 'inventory.json')
     version_inventory_path = os.path.join(version_root, 'inventory.json')
     inventory_hash_path = os.path.join(object_root, 'inventory.json.sha512')
     version_inventory_hash_path = os.path.join(version_root, 'inventory.json.sha512')
+    inventory_bytes = json.dumps(inventory).encode('utf8')
     with open(inventory_path, 'wb') as f:
-        f.write(json.dumps(inventory).encode('utf8'))
+        f.write(inventory_bytes)
     with open(version_inventory_path, 'wb') as f:
-        f.write(json.dumps(inventory).encode('utf8'))
-    inventory_hash = hashlib.sha512(json.dumps(inventory).encode('utf8')).hexdigest()
+        f.write(inventory_bytes)
+    inventory_hash = hashlib.sha512(inventory_bytes).hexdigest()
     inventory_hash_file_content = f'{inventory_hash}\tinventory.json'.encode('utf8')
     with open(inventory_hash_path, 'wb') as f:
         f.write(inventory_hash_file_content)
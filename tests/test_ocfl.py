@@ -1,10 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
 import copy
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+import hashlib
+import io
 import json
 import os
 import shutil
+import sqlite3
+import sys
+import tarfile
+import tempfile
 import timeit
 import unittest
+import zipfile
 from bdrocfl import ocfl, test_utils
 
 
@@ -86,6 +94,34 @@ SIMPLE_INVENTORY = {
 }
 
 
+def create_simple_object():
+    '''write out the SIMPLE_INVENTORY object, with content for v1 & v3'''
+    object_path = os.path.join(OCFL_ROOT, '1b5', '64f', '1ff', 'testsuite%3aabcd1234')
+    os.makedirs(object_path)
+    with open(os.path.join(object_path, 'inventory.json'), 'wb') as f:
+        f.write(json.dumps(SIMPLE_INVENTORY).encode('utf8'))
+    v1_content_path = os.path.join(object_path, 'v1', 'content')
+    v3_content_path = os.path.join(object_path, 'v3', 'content')
+    file_txt_path = os.path.join(v1_content_path, 'file.txt')
+    something_path = os.path.join(v3_content_path, 'something')
+    rels_int_path = os.path.join(v3_content_path, 'RELS-INT')
+    os.makedirs(v1_content_path)
+    os.makedirs(v3_content_path)
+    rels_int = '''<rdf:RDF xmlns:ns1="info:fedora/fedora-system:def/model#" xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about="info:fedora/testsuite:abcd1234/something">
+    <ns1:downloadFilename>some image.jpg</ns1:downloadFilename>
+    <rdf:type rdf:resource="http://pcdm.org/use#OriginalFile"/>
+  </rdf:Description>
+</rdf:RDF>'''
+    with open(file_txt_path, 'wb') as f:
+        f.write(b'1234')
+    with open(something_path, 'wb') as f:
+        f.write(b'abcdefg')
+    with open(rels_int_path, 'wb') as f:
+        f.write(rels_int.encode('utf8'))
+    return object_path
+
+
 class TestOcfl(unittest.TestCase):
 
     def setUp(self):
@@ -126,6 +162,8 @@ class TestOcfl(unittest.TestCase):
         self.assertEqual(ocfl.utc_datetime_from_string('2021-03-23T10:20:30.522328Z'), datetime(2021, 3, 23, 10, 20, 30, 522328, tzinfo=timezone.utc)) #common in new ocfl objs
         with self.assertRaises(ocfl.DateTimeError):
             ocfl.utc_datetime_from_string('2021-03-23T06:20:30')
+        with self.assertRaises(ocfl.DateTimeError):
+            ocfl.utc_datetime_from_string('not a date')
         #now time the functions
         print('datetime parsing speeds:')
         for date_string in ['2021-03-23T06:20:30.522328-04:00', '2021-03-23T06:20:30.52232-04:00', '2020-11-25T20:30:43.737Z', '2020-11-25T20:30:43.73776Z', '2020-11-25T20:30:43.737760Z']:
@@ -148,30 +186,8 @@ class TestOcfl(unittest.TestCase):
         self.assertEqual(obj.pid, 'testsuite:abcd1234')
 
     def test_object(self):
-        object_path = os.path.join(OCFL_ROOT, '1b5', '64f', '1ff', 'testsuite%3aabcd1234')
-        os.makedirs(object_path)
-        with open(os.path.join(object_path, 'inventory.json'), 'wb') as f:
-            f.write(json.dumps(SIMPLE_INVENTORY).encode('utf8'))
-        v1_content_path = os.path.join(object_path, 'v1', 'content')
-        v3_content_path = os.path.join(object_path, 'v3', 'content')
-        file_txt_path = os.path.join(v1_content_path, 'file.txt')
-        something_path = os.path.join(v3_content_path, 'something')
-        rels_int_path = os.path.join(v3_content_path, 'RELS-INT')
-        os.makedirs(v1_content_path)
-        os.makedirs(v3_content_path)
-        rels_int = '''<rdf:RDF xmlns:ns1="info:fedora/fedora-system:def/model#" xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
-  <rdf:Description rdf:about="info:fedora/testsuite:abcd1234/something">
-    <ns1:downloadFilename>some image.jpg</ns1:downloadFilename>
-    <rdf:type rdf:resource="http://pcdm.org/use#OriginalFile"/>
-  </rdf:Description>
-</rdf:RDF>'''
-
-        with open(file_txt_path, 'wb') as f:
-            f.write(b'1234')
-        with open(something_path, 'wb') as f:
-            f.write(b'abcdefg')
-        with open(rels_int_path, 'wb') as f:
-            f.write(rels_int.encode('utf8'))
+        object_path = create_simple_object()
+        file_txt_path = os.path.join(object_path, 'v1', 'content', 'file.txt')
         o = ocfl.Object(OCFL_ROOT, 'testsuite:abcd1234')
         self.assertEqual(o.get_path_to_file('renamed_file.txt'), file_txt_path)
         with self.assertRaises(FileNotFoundError):
@@ -251,6 +267,39 @@ class TestOcfl(unittest.TestCase):
             },
         })
 
+    def test_iter_files_info(self):
+        create_simple_object()
+        o = ocfl.Object(OCFL_ROOT, 'testsuite:abcd1234')
+        self.assertEqual([name for name, info in o.iter_files_info()], ['RELS-INT', 'RELS-INT2', 'renamed_file.txt', 'something', 'something else'])
+        self.assertEqual(list(o.iter_files_info(fields=['state'], include_deleted=True, start_after='RELS-INT2', limit=2)), [
+            ('file.txt', {'state': 'D'}),
+            ('renamed_file.txt', {'state': 'A'}),
+        ])
+        self.assertEqual(list(o.iter_files_info(start_after='something else')), [])
+        #info is looked up lazily, but matches get_files_info()
+        fields = ['state', 'size', 'checksum', 'checksumType', 'mimetype', 'downloadFilename', 'lastModified']
+        lazy_info = dict(o.iter_files_info(fields=fields, include_deleted=True))
+        self.assertIsNone(o._files_info)
+        self.assertEqual(lazy_info['file.txt']['lastModified'], datetime(2018, 10, 1, 12, 0, 0, tzinfo=timezone.utc))
+        self.assertEqual(lazy_info, o.get_files_info(fields=fields, include_deleted=True))
+        self.assertEqual(dict(o.iter_files_info(fields=fields, include_deleted=True)), lazy_info)
+
+    def test_iter_files_info_reads_versions_lazily(self):
+        pid = 'testsuite:abcd1234'
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, pid)
+        builder.add_bytes('b', b'1234')
+        builder.commit()
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, pid)
+        builder.add_bytes('c', b'efgh')
+        builder.commit()
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, pid)
+        builder.add_bytes('a', b'abcd')
+        builder.commit()
+        o = ocfl.Object(OCFL_ROOT, pid)
+        #'a' isn't in v2, so the v1 state is never needed for it
+        o._inventory['versions']['v1']['state'] = None
+        self.assertEqual(list(o.iter_files_info(fields=['state'], limit=1)), [('a', {'state': 'A'})])
+
     def test_root_inventory_error(self):
         object_path = os.path.join(OCFL_ROOT, '1b5', '64f', '1ff', 'testsuite%3aabcd1234')
         os.makedirs(object_path)
@@ -398,3 +447,785 @@ class TestFixity(unittest.TestCase):
         test_utils.create_object(OCFL_ROOT, self.pid, files=[('file1', b'abcd'), ('file2', b'1234')])
         obj = ocfl.Object(OCFL_ROOT, self.pid)
         ocfl.check_fixity(obj)
+
+
+class TestObjectBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.pid = 'testsuite:abcd1234'
+        self.object_root = ocfl.object_path(OCFL_ROOT, self.pid)
+        try:
+            shutil.rmtree(self.object_root)
+        except FileNotFoundError:
+            pass
+        self.source_dir = os.path.join(OCFL_ROOT, 'sources')
+        os.makedirs(self.source_dir, exist_ok=True)
+        self.source_path = os.path.join(self.source_dir, 'master.tif')
+        with open(self.source_path, 'wb') as f:
+            f.write(b'tiff bytes')
+
+    def tearDown(self):
+        shutil.rmtree(self.source_dir)
+
+    def test_new_object(self):
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid, message='ingest', user_name='Alice', user_address='alice@example.org', created='2021-03-23T10:20:30.522328Z')
+        builder.add_bytes('MODS', b'<mods/>')
+        builder.add_file('images/master.tif', self.source_path)
+        self.assertEqual(builder.commit(), 'v1')
+        obj = ocfl.Object(OCFL_ROOT, self.pid)
+        self.assertEqual(obj.head_version, 'v1')
+        self.assertEqual(obj.last_modified, datetime(2021, 3, 23, 10, 20, 30, 522328, tzinfo=timezone.utc))
+        self.assertEqual(sorted(obj.filenames), ['MODS', 'images/master.tif'])
+        with open(obj.get_path_to_file('images/master.tif'), 'rb') as f:
+            self.assertEqual(f.read(), b'tiff bytes')
+        self.assertEqual(obj._inventory['versions']['v1']['user'], {'name': 'Alice', 'address': 'alice@example.org'})
+        ocfl.check_fixity(obj)
+        self.assertEqual([name for name in os.listdir(os.path.join(self.object_root, 'v1', 'content', 'images'))], ['master.tif'])
+        self.assertEqual(sorted(os.listdir(self.object_root)), ['0=ocfl_object_1.0', 'inventory.json', 'inventory.json.sha512', 'v1'])
+        with open(os.path.join(self.object_root, '0=ocfl_object_1.0'), 'rb') as f:
+            self.assertEqual(f.read(), b'ocfl_object_1.0\n')
+
+    def test_new_version(self):
+        test_utils.create_object(OCFL_ROOT, self.pid, files=[('file1', b'abcd'), ('file2', b'1234')])
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.remove_file('file1')
+        builder.add_bytes('file2', b'5678')
+        builder.add_bytes('file3', b'efgh')
+        with self.assertRaises(FileNotFoundError):
+            builder.remove_file('nonexistent')
+        with self.assertRaises(ocfl.ObjectWriteError):
+            builder.add_bytes('../escape', b'')
+        self.assertEqual(builder.commit(), 'v2')
+        obj = ocfl.Object(OCFL_ROOT, self.pid)
+        self.assertEqual(sorted(obj.filenames), ['file2', 'file3'])
+        self.assertEqual(sorted(obj.all_filenames), ['file1', 'file2', 'file3'])
+        with open(obj.get_path_to_file('file2', version='v1'), 'rb') as f:
+            self.assertEqual(f.read(), b'1234')
+        with open(obj.get_path_to_file('file2'), 'rb') as f:
+            self.assertEqual(f.read(), b'5678')
+        ocfl.check_fixity(obj)
+        with self.assertRaises(ocfl.ObjectWriteError):
+            builder.commit()
+
+    def test_version_directory_exists(self):
+        test_utils.create_object(OCFL_ROOT, self.pid)
+        os.makedirs(os.path.join(self.object_root, 'v2'))
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        with self.assertRaises(ocfl.ObjectWriteError):
+            builder.commit()
+
+    def test_dedup(self):
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_file('master.tif', self.source_path)
+        builder.add_bytes('copy.tif', b'tiff bytes')
+        builder.add_bytes('MODS', b'<mods/>')
+        builder.commit()
+        self.assertEqual(builder.deduplicated, ['copy.tif'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.object_root, 'v1', 'content'))), ['MODS', 'master.tif'])
+        #metadata-only update - the master file is re-added, but not written again
+        master_checksum = ocfl.Object(OCFL_ROOT, self.pid).get_files_info(fields=['checksum'])['master.tif']['checksum']
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_file('master.tif', self.source_path)
+        builder.add_file('renamed.tif', '/nonexistent/path', checksum=master_checksum)
+        builder.add_bytes('MODS', b'<mods>updated</mods>')
+        builder.commit()
+        self.assertEqual(sorted(builder.deduplicated), ['master.tif', 'renamed.tif'])
+        self.assertEqual(os.listdir(os.path.join(self.object_root, 'v2', 'content')), ['MODS'])
+        obj = ocfl.Object(OCFL_ROOT, self.pid)
+        self.assertEqual(obj.get_path_to_file('renamed.tif'), os.path.join(self.object_root, 'v1', 'content', 'master.tif'))
+        ocfl.check_fixity(obj)
+        #without dedup, content is always written
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid, dedup=False)
+        builder.add_file('master.tif', self.source_path)
+        builder.commit()
+        self.assertEqual(builder.deduplicated, [])
+        self.assertEqual(os.listdir(os.path.join(self.object_root, 'v3', 'content')), ['master.tif'])
+        ocfl.check_fixity(ocfl.Object(OCFL_ROOT, self.pid))
+
+    def test_dedup_within_version(self):
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_bytes('a/x', b'same')
+        builder.add_bytes('b/c/y', b'same')
+        builder.commit()
+        self.assertEqual(len(builder.deduplicated), 1)
+        self.assertEqual(len(os.listdir(os.path.join(self.object_root, 'v1', 'content'))), 1)
+        self.assertEqual(ocfl.validate_object(OCFL_ROOT, self.pid), [])
+        obj = ocfl.Object(OCFL_ROOT, self.pid)
+        self.assertEqual(obj.get_path_to_file('a/x'), obj.get_path_to_file('b/c/y'))
+
+    def _count_file_sizes(self, commit):
+        original_get_file_size = ocfl.get_file_size
+        sized_paths = []
+
+        def counting_get_file_size(path):
+            sized_paths.append(path)
+            return original_get_file_size(path)
+
+        ocfl.get_file_size = counting_get_file_size
+        try:
+            commit()
+        finally:
+            ocfl.get_file_size = original_get_file_size
+        return len(sized_paths)
+
+    def test_metadata_only_commit(self):
+        test_utils.create_object(OCFL_ROOT, self.pid, files=[(f'file{i}', str(i).encode('utf8')) for i in range(20)])
+        #no add_file() sources, so the existing content isn't stat-ed
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_bytes('MODS', b'<mods/>')
+        self.assertEqual(self._count_file_sizes(builder.commit), 0)
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.remove_file('file1')
+        self.assertEqual(self._count_file_sizes(builder.commit), 0)
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_file('master.tif', self.source_path)
+        self.assertEqual(self._count_file_sizes(builder.commit), 22)
+        #an up-to-date checksum index already has the sizes
+        tmp_dir = tempfile.mkdtemp()
+        index = ocfl.ChecksumIndex(os.path.join(tmp_dir, 'checksums.sqlite3'), OCFL_ROOT)
+        try:
+            index.update_object(self.pid)
+            builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid, checksum_index=index)
+            builder.add_file('copy.tif', self.source_path)
+            #(not counting the index update after the commit)
+            index.update_object = lambda pid: None
+            self.assertEqual(self._count_file_sizes(builder.commit), 1)
+            self.assertEqual(builder.deduplicated, ['copy.tif'])
+        finally:
+            index.close()
+            shutil.rmtree(tmp_dir)
+
+    def test_checksum_mismatch(self):
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_file('master.tif', self.source_path, checksum='1234')
+        with self.assertRaises(ocfl.FixityError):
+            builder.commit()
+        self.assertFalse(os.path.exists(self.object_root))
+
+    def test_commit_after_failed_commit(self):
+        #failed first version - the object directory is cleaned up
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_file('master.tif', self.source_path, checksum='1234')
+        with self.assertRaises(ocfl.FixityError):
+            builder.commit()
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_file('master.tif', self.source_path)
+        self.assertEqual(builder.commit(), 'v1')
+        #failed later version - the version directory is cleaned up
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_bytes('MODS', b'<mods/>')
+        builder.add_file('missing.tif', os.path.join(self.source_dir, 'missing.tif'))
+        with self.assertRaises(FileNotFoundError):
+            builder.commit()
+        self.assertFalse(os.path.exists(os.path.join(self.object_root, 'v2')))
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_bytes('MODS', b'<mods/>')
+        self.assertEqual(builder.commit(), 'v2')
+        obj = ocfl.Object(OCFL_ROOT, self.pid)
+        self.assertEqual(sorted(obj.filenames), ['MODS', 'master.tif'])
+        self.assertEqual(ocfl.validate_object(OCFL_ROOT, self.pid), [])
+
+
+class TestChecksumIndex(unittest.TestCase):
+
+    def setUp(self):
+        for segment in ['1b5', '80a']:
+            try:
+                shutil.rmtree(os.path.join(OCFL_ROOT, segment))
+            except FileNotFoundError:
+                pass
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index = ocfl.ChecksumIndex(os.path.join(self.tmp_dir, 'checksums.sqlite3'), OCFL_ROOT)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index(self):
+        test_utils.create_object(OCFL_ROOT, 'testsuite:abcd1234', files=[('file1', b'abcd'), ('file2', b'1234')])
+        test_utils.create_object(OCFL_ROOT, 'testsuite:efgh5678', files=[('other', b'abcd')])
+        checksum = hashlib.sha512(b'abcd').hexdigest()
+        self.assertEqual(self.index.update(), {'updated': 2, 'removed': 0, 'errors': {}})
+        self.assertEqual(self.index.lookup(checksum), [
+            {'pid': 'testsuite:abcd1234', 'version': 'v1', 'logicalPath': 'file1', 'contentPath': 'v1/content/file1', 'size': 4},
+            {'pid': 'testsuite:efgh5678', 'version': 'v1', 'logicalPath': 'other', 'contentPath': 'v1/content/other', 'size': 4},
+        ])
+        self.assertEqual(list(self.index.duplicates()), [{'checksum': checksum, 'size': 4, 'pids': ['testsuite:abcd1234', 'testsuite:efgh5678']}])
+        #nothing changed, so nothing gets re-read
+        self.assertEqual(self.index.update(), {'updated': 0, 'removed': 0, 'errors': {}})
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, 'testsuite:abcd1234')
+        builder.remove_file('file1')
+        builder.commit()
+        shutil.rmtree(ocfl.object_path(OCFL_ROOT, 'testsuite:efgh5678'))
+        self.assertEqual(self.index.update(), {'updated': 1, 'removed': 1, 'errors': {}})
+        self.assertEqual([(r['version'], r['logicalPath']) for r in self.index.lookup(checksum)], [('v1', 'file1')])
+        self.assertEqual(list(self.index.duplicates()), [])
+
+    def test_builder_links_content_from_other_objects(self):
+        test_utils.create_object(OCFL_ROOT, 'testsuite:abcd1234', files=[('master.tif', b'tiff bytes')])
+        self.index.update()
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, 'testsuite:efgh5678', checksum_index=self.index)
+        builder.add_bytes('copy.tif', b'tiff bytes')
+        builder.add_bytes('MODS', b'<mods/>')
+        builder.commit()
+        self.assertEqual(builder.linked, ['copy.tif'])
+        obj = ocfl.Object(OCFL_ROOT, 'testsuite:efgh5678')
+        linked_stat = os.stat(obj.get_path_to_file('copy.tif'))
+        original_stat = os.stat(ocfl.Object(OCFL_ROOT, 'testsuite:abcd1234').get_path_to_file('master.tif'))
+        self.assertEqual(linked_stat.st_ino, original_stat.st_ino)
+        ocfl.check_fixity(obj)
+        #the builder updated the index for the new object
+        self.assertEqual(sorted(r['pid'] for r in self.index.lookup(hashlib.sha512(b'tiff bytes').hexdigest())), ['testsuite:abcd1234', 'testsuite:efgh5678'])
+
+    def test_builder_skips_stale_content(self):
+        test_utils.create_object(OCFL_ROOT, 'testsuite:abcd1234', files=[('master.tif', b'tiff bytes')])
+        self.index.update()
+        #the content changes after it was indexed
+        with open(os.path.join(ocfl.object_path(OCFL_ROOT, 'testsuite:abcd1234'), 'v1', 'content', 'master.tif'), 'wb') as f:
+            f.write(b'other bytes')
+        self.assertIsNone(self.index.find_content_path(hashlib.sha512(b'tiff bytes').hexdigest()))
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, 'testsuite:efgh5678', checksum_index=self.index)
+        builder.add_bytes('copy.tif', b'tiff bytes')
+        builder.commit()
+        self.assertEqual(builder.linked, [])
+        ocfl.check_fixity(ocfl.Object(OCFL_ROOT, 'testsuite:efgh5678'))
+
+    def test_builder_index_error(self):
+        def locked_update_object(pid):
+            raise sqlite3.OperationalError('database is locked')
+
+        self.index.update_object = locked_update_object
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, 'testsuite:abcd1234', checksum_index=self.index)
+        builder.add_bytes('MODS', b'<mods/>')
+        #the version is still committed
+        self.assertEqual(builder.commit(), 'v1')
+        self.assertEqual(builder.index_error, 'OperationalError: database is locked')
+        self.assertEqual(ocfl.Object(OCFL_ROOT, 'testsuite:abcd1234').head_version, 'v1')
+
+
+class TestChangeFeed(unittest.TestCase):
+
+    def setUp(self):
+        for segment in ['1b5', '80a']:
+            try:
+                shutil.rmtree(os.path.join(OCFL_ROOT, segment))
+            except FileNotFoundError:
+                pass
+        self.tmp_dir = tempfile.mkdtemp()
+        test_utils.create_object(OCFL_ROOT, 'testsuite:abcd1234')
+        test_utils.create_deleted_object(OCFL_ROOT, 'testsuite:efgh5678')
+        #make the first object look like it was written a long time ago
+        old_time = datetime(2019, 1, 1, tzinfo=timezone.utc).timestamp()
+        os.utime(os.path.join(ocfl.object_path(OCFL_ROOT, 'testsuite:abcd1234'), 'inventory.json'), (old_time, old_time))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_changed_since(self):
+        changes = sorted(ocfl.changed_since(OCFL_ROOT, None), key=lambda c: c['pid'])
+        self.assertEqual(changes, [
+            {'pid': 'testsuite:abcd1234', 'headVersion': 'v1', 'lastModified': datetime(2018, 10, 1, 12, 24, 59, 123456, tzinfo=timezone.utc), 'deleted': False},
+            {'pid': 'testsuite:efgh5678', 'headVersion': 'v2', 'lastModified': datetime(2019, 12, 1, 12, 24, 59, 123456, tzinfo=timezone.utc), 'deleted': True},
+        ])
+        changes = list(ocfl.changed_since(OCFL_ROOT, datetime(2020, 1, 1, tzinfo=timezone.utc)))
+        self.assertEqual([c['pid'] for c in changes], ['testsuite:efgh5678'])
+        #no root inventory - falls back to the lastModified of the version inventory
+        os.remove(os.path.join(ocfl.object_path(OCFL_ROOT, 'testsuite:efgh5678'), 'inventory.json'))
+        self.assertEqual(list(ocfl.changed_since(OCFL_ROOT, datetime(2020, 1, 1, tzinfo=timezone.utc))), [])
+        self.assertEqual([c['pid'] for c in ocfl.changed_since(OCFL_ROOT, datetime(2019, 6, 1, tzinfo=timezone.utc))], ['testsuite:efgh5678'])
+        #an object that can't be loaded doesn't stop the feed
+        with open(os.path.join(ocfl.object_path(OCFL_ROOT, 'testsuite:abcd1234'), 'inventory.json'), 'wb') as f:
+            f.write(b'{corrupt')
+        changes = sorted(ocfl.changed_since(OCFL_ROOT, datetime(2019, 6, 1, tzinfo=timezone.utc)), key=lambda c: c['pid'])
+        self.assertEqual([c['pid'] for c in changes], ['testsuite:abcd1234', 'testsuite:efgh5678'])
+        self.assertTrue(changes[0]['error'].startswith('JSONDecodeError: '))
+
+    def test_cursor(self):
+        feed = ocfl.ChangeFeed(OCFL_ROOT, os.path.join(self.tmp_dir, 'cursor.json'), overlap=timedelta(0))
+        self.assertEqual(feed.cursor, None)
+        self.assertEqual(sorted(c['pid'] for c in feed.changes()), ['testsuite:abcd1234', 'testsuite:efgh5678'])
+        feed.save()
+        self.assertTrue(feed.cursor <= datetime.now(timezone.utc))
+        feed = ocfl.ChangeFeed(OCFL_ROOT, os.path.join(self.tmp_dir, 'cursor.json'), overlap=timedelta(0))
+        self.assertEqual(list(feed.changes()), [])
+        test_utils.create_object(OCFL_ROOT, 'testsuite:abcd1234', files=[('file1', b'updated')])
+        self.assertEqual([c['pid'] for c in feed.changes()], ['testsuite:abcd1234'])
+
+
+class TestObjectCache(unittest.TestCase):
+
+    def setUp(self):
+        self.pid = 'testsuite:abcd1234'
+        try:
+            shutil.rmtree(ocfl.object_path(OCFL_ROOT, self.pid))
+        except FileNotFoundError:
+            pass
+        test_utils.create_object(OCFL_ROOT, self.pid)
+
+    def _check_invalidation(self, cache):
+        obj = cache.get(self.pid)
+        self.assertIs(cache.get(self.pid), obj)
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_bytes('file2', b'1234')
+        builder.commit()
+        obj = cache.get(self.pid)
+        self.assertEqual(obj.head_version, 'v2')
+        #test_utils rewrites the inventory in place, instead of replacing it
+        test_utils.create_deleted_object(OCFL_ROOT, self.pid)
+        with self.assertRaises(ocfl.ObjectDeleted):
+            cache.get(self.pid)
+        self.assertEqual(cache.get(self.pid, deleted_ok=True).head_version, 'v2')
+        self.assertEqual(cache.stats['hits'], 2)
+        self.assertEqual(cache.stats['misses'], 3)
+        self.assertEqual(cache.stats['invalidations'], 2)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is linux-only')
+    def test_inotify(self):
+        cache = ocfl.ObjectCache(OCFL_ROOT)
+        try:
+            self.assertIsNotNone(cache.watcher)
+            self._check_invalidation(cache)
+            self.assertEqual(cache.stats['statValidations'], 0)
+        finally:
+            cache.close()
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is linux-only')
+    def test_simultaneous_misses(self):
+        cache = ocfl.ObjectCache(OCFL_ROOT)
+        try:
+            #two threads missing on the same pid at the same time both insert it
+            get_cached = cache._get_cached
+            cache._get_cached = lambda pid: None
+            cache.get(self.pid)
+            cache.get(self.pid)
+            cache._get_cached = get_cached
+            self.assertTrue(cache.watcher.is_watched(ocfl.object_path(OCFL_ROOT, self.pid)))
+            builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+            builder.add_bytes('file2', b'1234')
+            builder.commit()
+            self.assertEqual(cache.get(self.pid).head_version, 'v2')
+        finally:
+            cache.close()
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is linux-only')
+    def test_change_while_loading(self):
+        cache = ocfl.ObjectCache(OCFL_ROOT)
+        original_object = ocfl.Object
+
+        def load_then_change(*args, **kwargs):
+            ocfl.Object = original_object
+            obj = original_object(*args, **kwargs)
+            builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+            builder.add_bytes('file2', b'1234')
+            builder.commit()
+            #another thread drains the watch events before this object is cached
+            cache._get_cached('testsuite:efgh5678')
+            return obj
+
+        ocfl.Object = load_then_change
+        try:
+            self.assertEqual(cache.get(self.pid).head_version, 'v1')
+            self.assertEqual(cache.get(self.pid).head_version, 'v2')
+        finally:
+            ocfl.Object = original_object
+            cache.close()
+
+    def test_stat_validation(self):
+        cache = ocfl.ObjectCache(OCFL_ROOT, inotify=False)
+        self._check_invalidation(cache)
+        self.assertEqual(cache.stats['statValidations'], 4)
+
+    def test_network_filesystem(self):
+        #inotify wouldn't see writes from other hosts, so it isn't used
+        original_is_network_filesystem = ocfl._is_network_filesystem
+        ocfl._is_network_filesystem = lambda path: True
+        try:
+            cache = ocfl.ObjectCache(OCFL_ROOT)
+        finally:
+            ocfl._is_network_filesystem = original_is_network_filesystem
+        self.assertIsNone(cache.watcher)
+        self._check_invalidation(cache)
+        self.assertEqual(cache.stats['statValidations'], 4)
+        self.assertTrue(ocfl._is_network_filesystem(os.path.join(OCFL_ROOT, 'nonexistent')))
+
+    def test_max_objects(self):
+        test_utils.create_object(OCFL_ROOT, 'testsuite:efgh5678')
+        cache = ocfl.ObjectCache(OCFL_ROOT, max_objects=1, inotify=False)
+        obj = cache.get(self.pid)
+        cache.get('testsuite:efgh5678')
+        self.assertIsNot(cache.get(self.pid), obj)
+        self.assertEqual(cache.stats['misses'], 3)
+        with self.assertRaises(ocfl.ObjectNotFound):
+            cache.get('testsuite:notthere')
+
+
+class TestRepoStats(unittest.TestCase):
+
+    def setUp(self):
+        for segment in ['1b5', '80a']:
+            try:
+                shutil.rmtree(os.path.join(OCFL_ROOT, segment))
+            except FileNotFoundError:
+                pass
+        self.tmp_dir = tempfile.mkdtemp()
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, 'testsuite:abcd1234')
+        builder.add_bytes('image.jpg', b'jpg bytes')
+        builder.add_bytes('MODS', b'<mods/>')
+        builder.commit()
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, 'testsuite:abcd1234')
+        builder.add_bytes('MODS', b'<mods>updated</mods>')
+        builder.add_bytes('copy.jpg', b'jpg bytes')
+        builder.commit()
+        test_utils.create_deleted_object(OCFL_ROOT, 'testsuite:efgh5678', files=[('file.txt', b'abcd')])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stats(self):
+        stats = ocfl.repo_stats(OCFL_ROOT, max_workers=2)
+        self.assertEqual(stats, {
+            'objects': 2,
+            'deletedObjects': 1,
+            'totalBytes': 9 + 7 + 20 + 4,
+            'versionBytes': 9 + 7 + 9 + 20 + 9 + 4,
+            #image.jpg carried over into v2 isn't a saving, but copy.jpg is
+            'addedBytes': 9 + 7 + 20 + 9 + 4,
+            'dedupSavings': 9,
+            'bytesByMimetype': {'image/jpeg': 9, 'text/xml': 27, 'text/plain': 4},
+            'versionCounts': {'2': 2},
+            'errors': {},
+        })
+
+    def test_object_error(self):
+        os.remove(os.path.join(ocfl.object_path(OCFL_ROOT, 'testsuite:abcd1234'), 'v2', 'content', 'MODS'))
+        stats = ocfl.repo_stats(OCFL_ROOT, max_workers=2)
+        #none of the broken object's partial stats are included
+        self.assertEqual(stats['objects'], 1)
+        self.assertEqual(stats['totalBytes'], 4)
+        self.assertEqual(stats['versionBytes'], 4)
+        self.assertEqual(stats['dedupSavings'], 0)
+        self.assertEqual(stats['bytesByMimetype'], {'text/plain': 4})
+        self.assertEqual(list(stats['errors']), ['testsuite:abcd1234'])
+
+    def test_checkpoint(self):
+        checkpoint_path = os.path.join(self.tmp_dir, 'checkpoint.json')
+        partial_stats = ocfl._shard_stats(OCFL_ROOT, '1b5')
+        partial_stats['objects'] = 1000
+        with open(checkpoint_path, 'wb') as f:
+            f.write(json.dumps({'completedShards': ['1b5'], 'stats': partial_stats}).encode('utf8'))
+        stats = ocfl.repo_stats(OCFL_ROOT, checkpoint_path=checkpoint_path)
+        self.assertEqual(stats['objects'], 1001)
+        self.assertEqual(stats['deletedObjects'], 1)
+        with open(checkpoint_path, 'rb') as f:
+            self.assertEqual(sorted(json.loads(f.read().decode('utf8'))['completedShards']), ['1b5', '80a'])
+
+
+class TestVersionArchive(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            shutil.rmtree(os.path.join(OCFL_ROOT, '1b5'))
+        except FileNotFoundError:
+            pass
+        create_simple_object()
+        self.obj = ocfl.Object(OCFL_ROOT, 'testsuite:abcd1234')
+
+    def test_zip(self):
+        archive = ocfl.VersionArchive(self.obj)
+        self.assertEqual(archive.content_type, 'application/zip')
+        self.assertEqual(archive.filename, 'testsuite_abcd1234_v5.zip')
+        data = b''.join(archive)
+        self.assertEqual(len(data), archive.size)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ['RELS-INT', 'RELS-INT2', 'renamed_file.txt', 'some image.jpg', 'something else'])
+            self.assertEqual(zf.read('some image.jpg'), b'abcdefg')
+            self.assertEqual(zf.read('renamed_file.txt'), b'1234')
+            self.assertEqual(zf.getinfo('RELS-INT').date_time, (2018, 10, 5, 12, 0, 0))
+
+    def test_tar(self):
+        archive = ocfl.VersionArchive(self.obj, version='v1', archive_format='tar')
+        self.assertEqual(archive.content_type, 'application/x-tar')
+        data = b''.join(archive)
+        self.assertEqual(len(data), archive.size)
+        with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+            self.assertEqual(tf.getnames(), ['file.txt', 'something'])
+            self.assertEqual(tf.extractfile('file.txt').read(), b'1234')
+            self.assertEqual(tf.getmember('something').size, 7)
+
+    def test_duplicate_names(self):
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, 'testsuite:abcd1234')
+        builder.add_bytes('RELS-INT', b'''<rdf:RDF xmlns:ns1="info:fedora/fedora-system:def/model#" xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about="info:fedora/testsuite:abcd1234/something">
+    <ns1:downloadFilename>image.jpg</ns1:downloadFilename>
+  </rdf:Description>
+  <rdf:Description rdf:about="info:fedora/testsuite:abcd1234/something else">
+    <ns1:downloadFilename>image.jpg</ns1:downloadFilename>
+  </rdf:Description>
+</rdf:RDF>''')
+        builder.commit()
+        obj = ocfl.Object(OCFL_ROOT, 'testsuite:abcd1234')
+        with zipfile.ZipFile(io.BytesIO(b''.join(ocfl.VersionArchive(obj)))) as zf:
+            self.assertEqual(zf.namelist(), ['RELS-INT', 'RELS-INT2', 'renamed_file.txt', 'image.jpg', 'something else'])
+
+
+class TestValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.pid = 'testsuite:abcd1234'
+        for segment in ['1b5', '80a']:
+            try:
+                shutil.rmtree(os.path.join(OCFL_ROOT, segment))
+            except FileNotFoundError:
+                pass
+        self.object_root = ocfl.object_path(OCFL_ROOT, self.pid)
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_bytes('file1', b'abcd')
+        builder.add_bytes('dir/file2', b'1234')
+        builder.commit()
+        builder = ocfl.ObjectBuilder(OCFL_ROOT, self.pid)
+        builder.add_bytes('file3', b'efgh')
+        builder.commit()
+
+    def _codes(self):
+        return [error['code'] for error in ocfl.validate_object(OCFL_ROOT, self.pid)]
+
+    def test_valid_object(self):
+        self.assertEqual(ocfl.validate_object(OCFL_ROOT, self.pid), [])
+
+    def test_not_found(self):
+        self.assertEqual([e['code'] for e in ocfl.validate_object(OCFL_ROOT, 'testsuite:efgh5678')], ['object_not_found'])
+
+    def test_content_errors(self):
+        os.remove(os.path.join(self.object_root, 'v1', 'content', 'dir', 'file2'))
+        with open(os.path.join(self.object_root, 'v2', 'content', 'orphan'), 'wb') as f:
+            f.write(b'orphan')
+        errors = ocfl.validate_object(OCFL_ROOT, self.pid)
+        self.assertEqual(errors, [
+            {'code': 'empty_content_directory', 'message': 'v1/content/dir is an empty directory'},
+            {'code': 'manifest_file_missing', 'message': 'v1/content/dir/file2 is in the manifest but doesn\'t exist'},
+            {'code': 'orphan_content_file', 'message': 'v2/content/orphan isn\'t in the manifest'},
+        ])
+
+    def test_inventory_errors(self):
+        obj = ocfl.Object(OCFL_ROOT, self.pid)
+        inventory = copy.deepcopy(obj._inventory)
+        inventory['versions']['v3'] = inventory['versions'].pop('v2')
+        inventory['head'] = 'v3'
+        inventory['versions']['v3']['state']['1234'] = ['bad']
+        test_utils.write_inventory_files(self.object_root, inventory)
+        with open(os.path.join(self.object_root, 'v1', 'inventory.json'), 'wb') as f:
+            f.write(b'{"versions": {"v1": {}}}')
+        self.assertEqual(self._codes(), [
+            'version_sequence_gap',
+            'unexpected_version_directory',
+            'version_inventory_mismatch',
+            'state_checksum_not_in_manifest',
+        ])
+
+    def test_malformed_inventory(self):
+        obj = ocfl.Object(OCFL_ROOT, self.pid)
+        inventory = copy.deepcopy(obj._inventory)
+        inventory['versions']['v1']['created'] = None
+        inventory['versions']['v2']['state'] = []
+        test_utils.write_inventory_files(self.object_root, inventory)
+        #the v1 inventory still has the original v1, so it doesn't match the root any more
+        self.assertEqual(self._codes(), ['invalid_version_state', 'version_inventory_mismatch', 'invalid_created_date'])
+        inventory['versions']['v1'] = None
+        test_utils.write_inventory_files(self.object_root, inventory)
+        self.assertEqual(self._codes(), ['invalid_version', 'invalid_version_state', 'version_inventory_mismatch'])
+        inventory['manifest'] = []
+        test_utils.write_inventory_files(self.object_root, inventory)
+        self.assertEqual(self._codes(), ['invalid_manifest'])
+        with open(os.path.join(self.object_root, 'inventory.json'), 'wb') as f:
+            f.write(b'[]')
+        self.assertEqual(self._codes(), ['inventory_invalid_type'])
+
+    def test_unexpected_error(self):
+        test_utils.create_object(OCFL_ROOT, 'testsuite:efgh5678')
+        original_validate_object = ocfl.validate_object
+
+        def broken_validate_object(storage_root, pid):
+            if pid == self.pid:
+                raise RuntimeError('unexpected')
+            return original_validate_object(storage_root, pid)
+
+        ocfl.validate_object = broken_validate_object
+        try:
+            self.assertEqual(ocfl._validate_shard(OCFL_ROOT, '1b5'), [(self.pid, [{'code': 'validation_error', 'message': 'RuntimeError: unexpected'}])])
+            self.assertEqual(ocfl._validate_shard(OCFL_ROOT, '80a'), [])
+        finally:
+            ocfl.validate_object = original_validate_object
+
+    def test_object_declaration(self):
+        declaration_path = os.path.join(self.object_root, '0=ocfl_object_1.0')
+        with open(declaration_path, 'wb') as f:
+            f.write(b'ocfl_object_2.0\n')
+        self.assertEqual(self._codes(), ['object_declaration_invalid'])
+        os.remove(declaration_path)
+        self.assertEqual(self._codes(), ['object_declaration_missing'])
+
+    def test_root_inventory_errors(self):
+        with open(os.path.join(self.object_root, 'inventory.json'), 'ab') as f:
+            f.write(b' ')
+        self.assertEqual(self._codes(), ['inventory_digest_mismatch', 'version_inventory_mismatch'])
+        os.remove(os.path.join(self.object_root, 'inventory.json'))
+        self.assertEqual(self._codes(), ['root_inventory_missing'])
+
+    def test_storage_root(self):
+        test_utils.create_object(OCFL_ROOT, 'testsuite:efgh5678')
+        self.assertEqual(list(ocfl.validate_storage_root(OCFL_ROOT, max_workers=2)), [])
+        os.remove(os.path.join(self.object_root, 'v2', 'inventory.json'))
+        self.assertEqual(list(ocfl.validate_storage_root(OCFL_ROOT, max_workers=2)), [
+            (self.pid, [{'code': 'version_inventory_missing', 'message': 'no v2 inventory.json'}]),
+        ])
+
+
+class TestContentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.pid = 'testsuite:abcd1234'
+        try:
+            shutil.rmtree(os.path.join(OCFL_ROOT, '1b5'))
+        except FileNotFoundError:
+            pass
+        self.cache_dir = tempfile.mkdtemp()
+        test_utils.create_object(OCFL_ROOT, self.pid, files=[('MODS', b'<mods/>'), ('RELS-INT', b'<rdf:RDF/>'), ('thumbnail.jpg', b'12345678')])
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache(self):
+        content_cache = ocfl.ContentCache(self.cache_dir, max_bytes=20)
+        obj = ocfl.Object(OCFL_ROOT, self.pid, content_cache=content_cache)
+        mods_path = obj.get_path_to_file('MODS')
+        self.assertTrue(mods_path.startswith(self.cache_dir))
+        with open(mods_path, 'rb') as f:
+            self.assertEqual(f.read(), b'<mods/>')
+        self.assertEqual(obj.get_path_to_file('MODS'), mods_path)
+        obj.get_path_to_file('RELS-INT')
+        self.assertEqual(content_cache.stats, {'hits': 1, 'misses': 2, 'evictions': 0, 'bypasses': 0, 'bytes': 17, 'files': 2, 'hitRate': 1/3})
+        #MODS is the least recently used, so it gets evicted
+        obj.get_path_to_file('thumbnail.jpg')
+        self.assertFalse(os.path.exists(mods_path))
+        self.assertEqual(content_cache.stats['evictions'], 1)
+        self.assertEqual(content_cache.stats['bytes'], 18)
+        #a new cache picks up the files already in the directory
+        content_cache = ocfl.ContentCache(self.cache_dir, max_bytes=20)
+        self.assertEqual(content_cache.stats['files'], 2)
+        #content bigger than the cache is served from the storage root
+        content_cache = ocfl.ContentCache(self.cache_dir, max_bytes=5)
+        obj = ocfl.Object(OCFL_ROOT, self.pid, content_cache=content_cache)
+        self.assertEqual(obj.get_path_to_file('thumbnail.jpg'), os.path.join(obj.object_path, 'v1', 'content', 'thumbnail.jpg'))
+        self.assertEqual(content_cache.stats['bypasses'], 1)
+
+    def test_open_file(self):
+        content_cache = ocfl.ContentCache(self.cache_dir, max_bytes=20)
+        obj = ocfl.Object(OCFL_ROOT, self.pid, content_cache=content_cache)
+        with obj.open_file('MODS') as mods_file:
+            self.assertTrue(mods_file.name.startswith(self.cache_dir))
+            #filling the cache evicts MODS, but the open file can still be read
+            obj.get_path_to_file('RELS-INT')
+            obj.get_path_to_file('thumbnail.jpg')
+            self.assertFalse(os.path.exists(mods_file.name))
+            self.assertEqual(mods_file.read(), b'<mods/>')
+        with obj.open_file('thumbnail.jpg') as f:
+            self.assertEqual(f.read(), b'12345678')
+        self.assertEqual(content_cache.stats['hits'], 1)
+        obj = ocfl.Object(OCFL_ROOT, self.pid)
+        with obj.open_file('MODS') as f:
+            self.assertEqual(f.read(), b'<mods/>')
+
+    def test_max_file_bytes(self):
+        content_cache = ocfl.ContentCache(self.cache_dir, max_bytes=1000, max_file_bytes=7)
+        obj = ocfl.Object(OCFL_ROOT, self.pid, content_cache=content_cache)
+        self.assertTrue(obj.get_path_to_file('MODS').startswith(self.cache_dir))
+        with obj.open_file('thumbnail.jpg') as f:
+            self.assertEqual(f.name, os.path.join(obj.object_path, 'v1', 'content', 'thumbnail.jpg'))
+            self.assertEqual(f.read(), b'12345678')
+        self.assertEqual(content_cache.stats['bypasses'], 1)
+        self.assertEqual(content_cache.stats['files'], 1)
+
+    def test_concurrent_fills(self):
+        content_cache = ocfl.ContentCache(self.cache_dir, max_bytes=1000)
+        obj = ocfl.Object(OCFL_ROOT, self.pid, content_cache=content_cache)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            paths = list(executor.map(lambda _: obj.get_path_to_file('thumbnail.jpg'), range(20)))
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(content_cache.stats['misses'], 1)
+        self.assertEqual(content_cache.stats['hits'], 19)
+
+    def test_fixity_error(self):
+        content_cache = ocfl.ContentCache(self.cache_dir, max_bytes=1000)
+        obj = ocfl.Object(OCFL_ROOT, self.pid, content_cache=content_cache)
+        with open(os.path.join(obj.object_path, 'v1', 'content', 'MODS'), 'wb') as f:
+            f.write(b'corrupted')
+        with self.assertRaises(ocfl.FixityError):
+            obj.get_path_to_file('MODS')
+        self.assertEqual(content_cache.stats['files'], 0)
+
+
+class TestCheckout(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            shutil.rmtree(os.path.join(OCFL_ROOT, '1b5'))
+        except FileNotFoundError:
+            pass
+        self.object_path = create_simple_object()
+        self.obj = ocfl.Object(OCFL_ROOT, 'testsuite:abcd1234')
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _read_tree(self, directory):
+        tree = {}
+        for dir_path, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                with open(path, 'rb') as f:
+                    tree[os.path.relpath(path, directory)] = f.read()
+        return tree
+
+    def test_hardlinks(self):
+        dest_dir = os.path.join(self.tmp_dir, 'checkout')
+        self.assertEqual(self.obj.checkout(None, dest_dir), {'linked': 5, 'reflinked': 0, 'copied': 0})
+        tree = self._read_tree(dest_dir)
+        self.assertEqual(sorted(tree), ['RELS-INT', 'RELS-INT2', 'renamed_file.txt', 'something', 'something else'])
+        self.assertEqual(tree['something else'], b'abcdefg')
+        self.assertEqual(os.stat(os.path.join(dest_dir, 'renamed_file.txt')).st_ino, os.stat(os.path.join(self.object_path, 'v1', 'content', 'file.txt')).st_ino)
+
+    def test_copies(self):
+        dest_dir = os.path.join(self.tmp_dir, 'checkout')
+        counts = self.obj.checkout('v1', dest_dir, hardlink=False)
+        self.assertEqual(counts['linked'], 0)
+        self.assertEqual(counts['reflinked'] + counts['copied'], 2)
+        self.assertEqual(self._read_tree(dest_dir), {'file.txt': b'1234', 'something': b'abcdefg'})
+        self.assertNotEqual(os.stat(os.path.join(dest_dir, 'file.txt')).st_ino, os.stat(os.path.join(self.object_path, 'v1', 'content', 'file.txt')).st_ino)
+        #existing files aren't overwritten
+        with self.assertRaises(FileExistsError):
+            self.obj.checkout('v1', dest_dir, hardlink=False)
+
+    def test_missing_content_file(self):
+        dest_dir = os.path.join(self.tmp_dir, 'checkout')
+        os.remove(os.path.join(self.object_path, 'v1', 'content', 'file.txt'))
+        with self.assertRaises(FileNotFoundError) as cm:
+            self.obj.checkout('v1', dest_dir, hardlink=False)
+        self.assertEqual(cm.exception.filename, os.path.join(self.object_path, 'v1', 'content', 'file.txt'))
+        self.assertFalse(os.path.exists(os.path.join(dest_dir, 'file.txt')))
+
+    def test_invalid_logical_path(self):
+        #the bad path comes after the good ones, but nothing gets written
+        state = self.obj._inventory['versions']['v5']['state']
+        state[list(state)[-1]].append('../outside')
+        with self.assertRaises(ocfl.InventoryError):
+            self.obj.checkout(None, os.path.join(self.tmp_dir, 'checkout'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'outside')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'checkout')))
+
+    def test_missing_content_file_with_hardlinks(self):
+        os.remove(os.path.join(self.object_path, 'v1', 'content', 'file.txt'))
+        with self.assertRaises(FileNotFoundError) as cm:
+            self.obj.checkout('v1', os.path.join(self.tmp_dir, 'checkout'))
+        self.assertEqual(cm.exception.filename, os.path.join(self.object_path, 'v1', 'content', 'file.txt'))